@@ -6,6 +6,55 @@ import uweb3
 # Application
 from . import pages
 
+
+class Warehouse(uweb3.uWeb):
+  """The uWeb3 application, which can stream large response bodies.
+
+  A handler that calls PageMaker.Stream leaves a generator in the WSGI
+  environ. That generator is returned to the server as the response body
+  instead of the (empty) body uWeb3 rendered, so it is sent as it is produced.
+
+  The request's pooled database connection is returned to the pool once the
+  response is complete, which for a streamed body is when it has been sent.
+  """
+
+  def __call__(self, env, start_response):
+    def StartResponse(status, headers, exc_info=None):
+      if pages.STREAMKEY in env:
+        headers = [(name, value) for name, value in headers
+                   if name.lower() != 'content-length']
+      return start_response(status, headers, exc_info)
+
+    try:
+      body = list(super().__call__(env, StartResponse))
+    except BaseException:
+      env.pop(pages.STREAMKEY, None)
+      pages.PageMaker.ReleaseConnection(env, check=True)
+      raise
+    if pages.STREAMKEY not in env:
+      pages.PageMaker.ReleaseConnection(env)
+      return body
+    return StreamedBody(env.pop(pages.STREAMKEY), env)
+
+
+class StreamedBody:
+  """A streamed response body that releases the request's database connection
+  when the server closes it, also when the client went away halfway."""
+
+  def __init__(self, stream, env):
+    self.stream = stream
+    self.env = env
+
+  def __iter__(self):
+    return iter(self.stream)
+
+  def close(self):
+    try:
+      self.stream.close()
+    finally:
+      pages.PageMaker.ReleaseConnection(self.env)
+
+
 def main():
   """Creates a uWeb3 application.
 
@@ -15,8 +64,11 @@ def main():
   - The routes iterable, where each 2-tuple defines a url-pattern and the
     name of a presenter method which should handle it.
   - The execution path, internally used to find templates etc.
+
+  All templates are compiled here, so forked workers share them.
   """
-  return uweb3.uWeb(pages.PageMaker,
+  pages.PageMaker.LoadTemplates()
+  return Warehouse(pages.PageMaker,
       [
 
        ('/', 'RequestProductNew', 'POST'),
@@ -36,6 +88,7 @@ def main():
        ('/setup', 'RequestSetup'),
        ('/admin', 'RequestAdmin'),
 
+       ('/import', 'RequestImport'),
        ('/gs1', 'RequestGS1'),
        ('/ean', 'RequestEAN'),
 
@@ -52,8 +105,13 @@ def main():
        ('/product/([^/]*)/assembly', 'RequestProductAssemblySave', 'POST'),
        ('/product/([^/]*)/stock', 'RequestProductStock', 'POST'),
 
+       ('/api/v1/search', 'JsonProductSearch', 'GET'),
+       ('/api/v1/products', 'JsonProducts', 'GET'),
        ('/api/v1/product/([^/]*)', 'JsonProduct', 'GET'),
        ('/api/v1/product/([^/]*)/stock', 'JsonProductStock', 'POST'),
+       ('/api/v1/product/([^/]*)/partoptions', 'JsonPartOptions', 'GET'),
+       ('/api/v1/stock/batch', 'JsonStockBatch', 'POST'),
+       ('/api/v1/stock/export', 'RequestStockExport', 'GET'),
 
        # Helper files
        ('(/styles/.*)', 'Static'),
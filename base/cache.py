@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+"""In-process caches for the uWeb3 warehouse inventory software"""
+
+# standard modules
+import collections
+import threading
+import time
+
+
+class LRUCache:
+  """A bounded cache that expires its entries after a number of seconds.
+
+  When the cache is full, the least recently used entry is dropped. Hits and
+  misses are counted so the effectiveness of the cache can be inspected.
+  """
+
+  def __init__(self, maxsize=1024, ttl=10):
+    """Sets up the cache.
+
+    Arguments:
+      % maxsize: int ~~ 1024
+        Number of entries to keep at most.
+      % ttl: float ~~ 10
+        Seconds an entry stays valid when no other ttl is given for it.
+    """
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def Get(self, key, default=None):
+    """Returns the cached value for key, or default if it is missing or expired."""
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None or entry[0] < time.monotonic():
+        if entry is not None:
+          del self._entries[key]
+        self.misses += 1
+        return default
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry[1]
+
+  def Set(self, key, value, ttl=None):
+    """Stores value for key, for ttl seconds or the cache's default ttl."""
+    with self._lock:
+      self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl),
+                            value)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.maxsize:
+        self._entries.popitem(last=False)
+
+  def Invalidate(self, key):
+    """Removes the entry for key, if there is one."""
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def Discard(self, predicate):
+    """Removes the entries whose value matches the predicate."""
+    with self._lock:
+      for key in [key for key, (_expires, value) in self._entries.items()
+                  if predicate(value)]:
+        del self._entries[key]
+
+  def Clear(self):
+    """Removes all entries."""
+    with self._lock:
+      self._entries.clear()
+
+  def Stats(self):
+    """Returns the hit and miss counters and the size of the cache."""
+    with self._lock:
+      return {'hits': self.hits,
+              'misses': self.misses,
+              'size': len(self._entries),
+              'maxsize': self.maxsize}
+
+
+class SingleFlight:
+  """Lets concurrent callers that ask for the same key share one computation.
+
+  The first caller for a key runs the function. Callers asking for that key
+  while it runs wait for it to finish, and get the same result or exception.
+  """
+
+  def __init__(self):
+    self.calls = 0
+    self.shared = 0
+    self._flights = {}
+    self._lock = threading.Lock()
+
+  def Do(self, key, function):
+    """Returns the result of function, or of the running call for key.
+
+    Arguments:
+      @ key: hashable
+        Identifies the computation.
+      @ function: callable
+        Computes the result, called without arguments.
+    """
+    with self._lock:
+      self.calls += 1
+      flight = self._flights.get(key)
+      leader = flight is None
+      if leader:
+        flight = self._flights[key] = _Flight()
+      else:
+        self.shared += 1
+    if not leader:
+      flight.done.wait()
+      if flight.error is not None:
+        raise flight.error
+      return flight.result
+    try:
+      flight.result = function()
+    except Exception as error:
+      flight.error = error
+      raise
+    finally:
+      with self._lock:
+        del self._flights[key]
+      flight.done.set()
+    return flight.result
+
+  def Stats(self):
+    """Returns the number of calls, and how many of those shared a result."""
+    with self._lock:
+      return {'calls': self.calls,
+              'shared': self.shared,
+              'running': len(self._flights)}
+
+
+class _Flight:
+  """The state of a single running computation."""
+  __slots__ = ('done', 'result', 'error')
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
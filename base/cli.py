@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+"""Commandline maintenance tools for the uWeb3 warehouse inventory software"""
+
+# standard modules
+import argparse
+import configparser
+import os
+import sys
+
+# project modules
+from . import importer
+from . import model
+from . import pool
+from .settings import CONFIGFILE
+
+
+def Pool(configfile=CONFIGFILE):
+  """Returns a connection pool configured by the [mysql] section of the
+  application's config file."""
+  config = configparser.ConfigParser()
+  config.read(configfile)
+  return pool.FromOptions(config['mysql'], name='cli')
+
+
+def StockCommand(connection, arguments):
+  """Checks, repairs or rebuilds the stock balances from the stock ledger."""
+  if arguments.rebuild:
+    model.Stockbalance.Rebuild(connection)
+    print('Stock balances rebuilt from the stock ledger.')
+    return 0
+  mismatches = model.Stockbalance.Reconcile(connection, repair=arguments.repair)
+  for mismatch in mismatches:
+    print('product %(product)d: ledger %(ledger)d, balance %(balance)d' % mismatch)
+  if not mismatches:
+    print('All stock balances match the stock ledger.')
+  elif arguments.repair:
+    print('Repaired %d stock balances.' % len(mismatches))
+    return 0
+  return 1 if mismatches else 0
+
+
+def SearchCommand(connection, arguments):
+  """Rebuilds the product search index."""
+  indexed = model.Productsearch.Rebuild(connection)
+  print('Indexed %d products.' % indexed)
+  return 0
+
+
+def ImportCommand(connection, arguments):
+  """Imports suppliers, products and parts from a csv, json or jsonl file."""
+  fileformat = arguments.format or os.path.splitext(arguments.file)[1][1:].lower()
+  try:
+    with open(arguments.file, newline='', encoding='utf-8-sig') as textfile:
+      report = importer.Importer(connection, dryrun=arguments.dry_run).Import(
+          importer.Rows(textfile, fileformat))
+  except ValueError as error:
+    print('Cannot read %s: %s' % (arguments.file, error))
+    return 1
+  for error in report['errors']:
+    print('row %(row)d (%(type)s %(name)s): %(error)s' % error)
+  for kind in importer.KINDS:
+    print('%s: %d %s, %d %s' % (
+        kind,
+        report['created'][kind], 'to create' if arguments.dry_run else 'created',
+        report['updated'][kind], 'to update' if arguments.dry_run else 'updated'))
+  return 1 if report['errors'] else 0
+
+
+def main(argv=None):
+  """Parses the commandline and runs the requested maintenance command."""
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--config', default=CONFIGFILE,
+                      help='config file holding the [mysql] settings')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  stock = commands.add_parser('stock', help=StockCommand.__doc__)
+  stock.set_defaults(function=StockCommand)
+  action = stock.add_mutually_exclusive_group()
+  action.add_argument('--repair', action='store_true',
+                      help='overwrite mismatching balances with the ledger sum')
+  action.add_argument('--rebuild', action='store_true',
+                      help='recreate all balances from the stock ledger')
+
+  search = commands.add_parser('search', help=SearchCommand.__doc__)
+  search.set_defaults(function=SearchCommand)
+  search.add_argument('--rebuild', action='store_true', required=True,
+                      help='reindex the name, description and sku of all products')
+
+  load = commands.add_parser('import', help=ImportCommand.__doc__)
+  load.set_defaults(function=ImportCommand)
+  load.add_argument('file', help='file holding a row per supplier, product or part')
+  load.add_argument('--format', choices=importer.FORMATS,
+                    help='format of the file, by default taken from its extension')
+  load.add_argument('--dry-run', action='store_true',
+                    help='report what would be imported without writing anything')
+
+  arguments = parser.parse_args(argv)
+  connections = Pool(arguments.config)
+  try:
+    with connections.Connection() as connection:
+      return arguments.function(connection, arguments)
+  finally:
+    connections.Close()
+
+
+if __name__ == '__main__':
+  sys.exit(main())
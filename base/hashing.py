@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+"""Password hashing for the uWeb3 warehouse inventory software
+
+Hashing and verifying a password with pbkdf2 takes tens of milliseconds of
+CPU. That work is done in a small pool of worker processes, so a burst of
+logins does not keep the request workers from serving other requests.
+"""
+
+# standard modules
+import concurrent.futures
+import os
+import secrets
+import threading
+import time
+
+# Custom modules
+from passlib.hash import pbkdf2_sha256
+
+# project modules
+from . import cache
+
+
+class HasherBusyError(Exception):
+  """Too many passwords are waiting to be hashed already."""
+
+
+def _Hash(password, rounds, salt=None):
+  """Hashes the password, runs in a hashing process."""
+  started = time.time()
+  if salt is None:
+    handler = pbkdf2_sha256.using(rounds=rounds)
+  else:
+    handler = pbkdf2_sha256.using(rounds=rounds, salt=salt)
+  return handler.hash(password), started
+
+
+def _Verify(password, hashed, rounds):
+  """Verifies the password against the hash, runs in a hashing process.
+
+  When the password is right but was hashed with another number of rounds, it
+  is hashed again with the current rounds, so it can be stored.
+  """
+  started = time.time()
+  try:
+    valid = pbkdf2_sha256.verify(password, hashed)
+  except (TypeError, ValueError):
+    return (False, None), started
+  newhash = None
+  if valid and pbkdf2_sha256.from_string(hashed).rounds != rounds:
+    newhash = pbkdf2_sha256.using(rounds=rounds).hash(password)
+  return (valid, newhash), started
+
+
+class Hasher:
+  """Hashes and verifies passwords in a pool of worker processes.
+
+  At most `processes` passwords are hashed at the same time. Callers beyond
+  that wait in a queue of at most `maxpending` jobs, and are turned away with
+  a HasherBusyError when the queue stays full for `timeout` seconds.
+
+  UnknownHash returns a hash of a random password, made with the configured
+  rounds. Logins for unknown users verify against it, so they take as long as
+  logins for existing users. No password matches it.
+  """
+
+  def __init__(self, processes=2, maxpending=16, timeout=5, rounds=None):
+    """Sets up the hasher, the processes are started on first use.
+
+    Arguments:
+      % processes: int ~~ 2
+        Number of passwords hashed at the same time.
+      % maxpending: int ~~ 16
+        Number of hashing jobs running or waiting at most.
+      % timeout: float ~~ 5
+        Seconds to wait for a place in the queue.
+      % rounds: int ~~ None
+        pbkdf2 rounds for new hashes, by default passlib's default.
+    """
+    self.options = None
+    self.stats = {'jobs': 0,
+                  'rejected': 0,
+                  'rehashed': 0,
+                  'pending': 0,
+                  'maxpending': 0,
+                  'waittime': 0.0,
+                  'maxwaittime': 0.0,
+                  'hashtime': 0.0}
+    self._lock = threading.Lock()
+    self._executor = None
+    self._pid = None
+    self._Setup(processes, maxpending, timeout, rounds)
+
+  def _Setup(self, processes, maxpending, timeout, rounds):
+    self.processes = max(int(processes), 1)
+    self.maxpending = max(int(maxpending), self.processes)
+    self.timeout = float(timeout)
+    self.rounds = int(rounds or pbkdf2_sha256.default_rounds)
+    self._slots = threading.BoundedSemaphore(self.maxpending)
+    self._unknownhash = None
+
+  def Configure(self, options):
+    """Applies the processes, maxpending, timeout and rounds options from the
+    [hashing] config section, or the defaults when options is None.
+
+    Nothing is done when these are the same options as last time, so this can
+    be called with the section of the current settings snapshot on every
+    request. Only a new snapshot makes the hasher set up again.
+    """
+    if options is self.options:
+      return
+    with self._lock:
+      self.options = options
+      options = options or {}
+      self._Setup(options.get('processes', 2), options.get('maxpending', 16),
+                  options.get('timeout', 5), options.get('rounds'))
+      if self._executor is not None and self._pid == os.getpid():
+        self._executor.shutdown(wait=False)
+      self._executor = None
+
+  def _Executor(self):
+    with self._lock:
+      if self._executor is None or self._pid != os.getpid():
+        self._executor = concurrent.futures.ProcessPoolExecutor(self.processes)
+        self._pid = os.getpid()
+      return self._executor
+
+  def _Run(self, function, *args):
+    """Runs function in a hashing process, and returns its result."""
+    slots = self._slots
+    if not slots.acquire(timeout=self.timeout):
+      with self._lock:
+        self.stats['rejected'] += 1
+      raise HasherBusyError('Too many logins at the moment, try again shortly.')
+    try:
+      with self._lock:
+        self.stats['jobs'] += 1
+        self.stats['pending'] += 1
+        self.stats['maxpending'] = max(self.stats['maxpending'],
+                                       self.stats['pending'])
+      submitted = time.time()
+      try:
+        result, started = self._Executor().submit(function, *args).result()
+      except concurrent.futures.BrokenExecutor:
+        with self._lock:
+          self._executor = None
+        raise
+      finished = time.time()
+      with self._lock:
+        waittime = max(started - submitted, 0)
+        self.stats['waittime'] += waittime
+        self.stats['maxwaittime'] = max(self.stats['maxwaittime'], waittime)
+        self.stats['hashtime'] += finished - started
+      return result
+    finally:
+      with self._lock:
+        self.stats['pending'] -= 1
+      slots.release()
+
+  def UnknownHash(self):
+    """Returns the hash that logins for unknown users are verified against,
+    hashing a random password in a hashing process on first use.
+
+    Raises:
+      HasherBusyError: the hashing queue is full.
+    """
+    unknownhash = self._unknownhash
+    if unknownhash is None:
+      unknownhash = self._unknownhash = self.Hash(secrets.token_hex(16))
+    return unknownhash
+
+  def Hash(self, password, salt=None):
+    """Returns the pbkdf2 hash of the password.
+
+    Raises:
+      HasherBusyError: the hashing queue is full.
+    """
+    return self._Run(_Hash, password, self.rounds, salt)
+
+  def Verify(self, password, hashed):
+    """Returns whether the password matches the hash, and a new hash of the
+    password when the stored hash uses other rounds than configured.
+
+    Raises:
+      HasherBusyError: the hashing queue is full.
+    """
+    valid, newhash = self._Run(_Verify, password, hashed, self.rounds)
+    if newhash:
+      with self._lock:
+        self.stats['rehashed'] += 1
+    return valid, newhash
+
+  def Stats(self):
+    """Returns the job counters, with the average wait for a hashing process
+    and the average hashing time in milliseconds."""
+    with self._lock:
+      stats = dict(self.stats, processes=self.processes, queue=self.maxpending,
+                   rounds=self.rounds)
+    jobs = stats['jobs'] or 1
+    stats['averagewait'] = round(stats['waittime'] / jobs * 1000, 3)
+    stats['maxwait'] = round(stats['maxwaittime'] * 1000, 3)
+    stats['averagehash'] = round(stats['hashtime'] / jobs * 1000, 3)
+    return stats
+
+
+class Throttle:
+  """Counts failed attempts per account and per client address.
+
+  Once either reaches its limit, further attempts are refused without hashing
+  anything, until there were no failures for `window` seconds. Counts are kept
+  per worker process.
+  """
+
+  def __init__(self, accountlimit=5, addresslimit=20, window=300):
+    self.accountlimit = accountlimit
+    self.addresslimit = addresslimit
+    self.failures = cache.LRUCache(maxsize=8192, ttl=window)
+    self._lock = threading.Lock()
+
+  def Allowed(self, account=None, address=None):
+    """Returns whether another attempt for the account and address is allowed."""
+    return (self.failures.Get(('account', account), 0) < self.accountlimit and
+            self.failures.Get(('address', address), 0) < self.addresslimit)
+
+  def Failed(self, account=None, address=None):
+    """Counts a failed attempt for the account and address."""
+    with self._lock:
+      for key in (('account', account), ('address', address)):
+        if key[1] is not None:
+          self.failures.Set(key, self.failures.Get(key, 0) + 1)
+
+  def Succeeded(self, account):
+    """Clears the failures of the account after a successful attempt."""
+    self.failures.Invalidate(('account', account))
+
+
+HASHER = Hasher()
+THROTTLE = Throttle()
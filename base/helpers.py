@@ -3,7 +3,18 @@
 __author__ = 'Jan Klopper (jan@underdark.nl)'
 __version__ = 0.1
 
-import math
+import base64
+import binascii
+import json
+
+def CountKey(modelCall, modelargs):
+  """Returns a key identifying the listing of a model call, for count caches."""
+  owner = getattr(modelCall, '__self__', None)
+  return (getattr(modelCall, '__qualname__', repr(modelCall)),
+          None if isinstance(owner, type) else getattr(owner, 'key', None),
+          repr(sorted((key, value) for key, value in modelargs.items()
+                      if key not in ('limit', 'offset', 'order',
+                                     'yield_unlimited_total_first'))))
 
 class SortTable:
   def __init__(self,
@@ -26,64 +37,175 @@ class SortTable:
   def __iter__(self):
     return iter(self.items)
 
-class PagedResult:
+class SeekPagedResult:
+  """Pages through a model listing by seeking past the last shown row.
+
+  Rather than skipping `offset` rows, each page is selected with a condition
+  on the order column and the ID of the row at the edge of the previous page.
+  With an index on those columns every page costs the same, no matter how
+  deep it is.
+
+  Pages are addressed with opaque tokens: the `next` and `prev` members hold
+  the tokens for the neighbouring pages (or None), `last` the token for the
+  final page. An empty token is the first page.
+  """
+  LASTPAGE = 'last'
+  ESTIMATE = 'estimate'
+
   def __init__(self,
                pagesize,
                page,
                modelCall,
                connection=None,
                modelargs=None,
-               maxlinks=10):
-    """Returns a dictionary with pagination information based on parameters.
+               order=('ID', True),
+               idcolumn='ID',
+               count=False,
+               prefetch=None,
+               countcache=None,
+               counttables=()):
+    """Selects the requested page.
 
     Takes:
       pagesize: Number specifying the amount of items per page, int
-      page: The current page number, int
+      page: The page token as given in a next, prev or last member, str
       modelCall: Function object for calling the model, function
       connection: An optional database connection object, object
       modelargs: An optional model call argument dictionary, dict
+      order: The column to page on and whether it is descending, tuple
+      idcolumn: The unique column used to order rows with equal values, str
+      count: Whether the totalcount should be looked up, True for an exact
+             count, ESTIMATE for the estimated size of the first of the
+             counttables, bool or str
+      prefetch: Optional foreign relations to load for all items in one query
+                each, using the Prefetch method of the items' model, tuple
+      countcache: Optional cache for the totalcount, model.CountCache
+      counttables: The tables the listing reads from, tuple
 
-   Creates the following members:
+    Creates the following members:
       pagesize: The pagesize variable given as a parameter, int
-      offset: The offset based on the pagesize, int
-      totalcount: The total item count for the unpaginated query, int
-      pagecount: The total page count, int
-      last: The last page number, int
-      next:  The next page number, int
-      prev: The previous page number, int
-      current: The current page number, int
+      items: The items on this page, list
+      next: Token for the next page, or None if this is the last page, str
+      prev: Token for the previous page, or None if this is the first page, str
+      last: Token for the last page, or None if this is the last page, str
+      totalcount: The total item count when requested, else None, int
+      estimated: Whether the totalcount is an estimate, bool
     """
-    modelargs = {} if modelargs is None else modelargs
+    self._modelCall = modelCall
+    self._connection = connection
+    self._modelargs = {} if modelargs is None else modelargs
+    self._count = count
+    self._countcache = countcache
+    self._counttables = counttables
+    self._totalcount = None
+    self.estimated = False
     self.pagesize = int(pagesize)
-    try:
-      self.current = int(page)
-    except:
-      self.current = 0
+    self.column, self.descending = order
+    self.idcolumn = idcolumn
 
-    self.offset = modelargs['offset'] = self.pagesize * (self.current - 1)
-    modelargs['yield_unlimited_total_first'] = True
-    modelargs['limit'] = self.pagesize
-    if (connection and type(modelCall.__self__) is type):  # is this in unbound method?, ifso it needs a connection argument
-      items = list(modelCall(connection, **modelargs))
-    else:  # is a bound method of a model object that already has a connection reference
-      items = list(modelCall(**modelargs))
-    self.totalcount = itemcount = items[0]
-    self.items = items[1:]
-    self.last = self.pagecount = int(math.ceil(float(itemcount) / self.pagesize))
-
-    pagenumbers = []
-    if self.pagecount < maxlinks:
-      self.pagenumbers = range(1, self.pagecount + 1)
+    backwards = False
+    seek = None
+    if page == self.LASTPAGE:
+      backwards = True
+    elif page:
+      try:
+        direction, seek = page[0], self._Decode(page[1:])
+        backwards = direction == 'b'
+      except (ValueError, TypeError, IndexError, binascii.Error):
+        seek = None
+
+    modelargs = dict(self._modelargs)
+    modelargs['conditions'] = list(modelargs.get('conditions', []))
+    if seek:
+      modelargs['conditions'].append(
+          self._SeekCondition(seek[0], seek[1], self.descending != backwards))
+    modelargs['order'] = [(self.column, self.descending != backwards),
+                          (self.idcolumn, self.descending != backwards)]
+    modelargs['limit'] = self.pagesize + 1
+    items = list(self._Call(modelargs))
+    more = len(items) > self.pagesize
+    items = items[:self.pagesize]
+    if backwards:
+      items.reverse()
+    self.items = items
+    if prefetch and self.items:
+      type(self.items[0]).Prefetch(self.items[0].connection, self.items, prefetch)
+
+    first_token = self._Token('b', items[0]) if items else None
+    last_token = self._Token('a', items[-1]) if items else None
+    if backwards:
+      self.prev = first_token if more else None
+      self.next = last_token if seek else None
     else:
-      self.pagenumbers = [*range(max(1,
-                                     self.current - int(maxlinks / 2)),
-                                 self.current),
-                          self.current,
-                          *range(self.current + 1,
-                             min(self.current + int(maxlinks / 2) + 1,
-                                 self.pagecount + 1))]
-    self.next = self.current + 1 if self.current + 1 <= self.pagecount else None
-    self.prev = self.current - 1 if self.current > 1 else None
+      self.prev = first_token if seek else None
+      self.next = last_token if more else None
+    self.last = self.LASTPAGE if self.next else None
+
+  def _Call(self, modelargs):
+    if (self._connection and type(self._modelCall.__self__) is type):  # is this in unbound method?, ifso it needs a connection argument
+      return self._modelCall(self._connection, **modelargs)
+    return self._modelCall(**modelargs)
+
+  def _Escape(self, value):
+    connection = self._connection or self._modelCall.__self__.connection
+    return connection.EscapeValues(value)
+
+  def _SeekCondition(self, value, key, descending):
+    """Returns the condition for rows after (value, key) in the given order.
+
+    NULL values sort before all others, as they do in MySQL."""
+    if self.column == self.idcolumn:
+      return '%s %s %d' % (self.idcolumn, '<' if descending else '>', key)
+    comparison = '<' if descending else '>'
+    if value is None:
+      if descending:
+        return '(%s IS NULL AND %s < %d)' % (self.column, self.idcolumn, key)
+      return '((%s IS NULL AND %s > %d) OR %s IS NOT NULL)' % (
+          self.column, self.idcolumn, key, self.column)
+    condition = '(%s %s %s OR (%s = %s AND %s %s %d)' % (
+        self.column, comparison, self._Escape(value),
+        self.column, self._Escape(value), self.idcolumn, comparison, key)
+    if descending:
+      condition += ' OR %s IS NULL' % self.column
+    return condition + ')'
+
+  def _Token(self, direction, item):
+    value = item[self.column.split('.')[-1]]
+    if value is not None and not isinstance(value, (int, float)):
+      value = str(value)
+    return direction + base64.urlsafe_b64encode(json.dumps(
+        [value, int(item[self.idcolumn.split('.')[-1]])]).encode()).decode()
+
+  @staticmethod
+  def _Decode(token):
+    value, key = json.loads(base64.urlsafe_b64decode(token.encode()))
+    return value, int(key)
+
+  def _Count(self):
+    modelargs = dict(self._modelargs)
+    modelargs['limit'] = 1
+    modelargs['yield_unlimited_total_first'] = True
+    return next(iter(self._Call(modelargs)))
+
+  @property
+  def totalcount(self):
+    """The total item count for the unpaginated query, only when requested"""
+    if self._count and self._totalcount is None:
+      connection = self._connection or self._modelCall.__self__.connection
+      if self._count == self.ESTIMATE and self._countcache and self._counttables:
+        self.estimated = True
+        self._totalcount = self._countcache.Estimate(connection,
+                                                     self._counttables[0])
+      elif self._countcache and self._counttables:
+        self._totalcount = self._countcache.Count(
+            connection, self._counttables,
+            CountKey(self._modelCall, self._modelargs), self._Count)
+      else:
+        self._totalcount = self._Count()
+    return self._totalcount
 
   def __iter__(self):
     return iter(self.items)
+
+  def __len__(self):
+    return len(self.items)
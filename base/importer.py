@@ -0,0 +1,479 @@
+#!/usr/bin/python3
+"""Bulk import of suppliers, products and assemblies for the uWeb3 warehouse"""
+
+# standard modules
+import csv
+import json
+import re
+
+# project modules
+from . import model
+
+KINDS = ('supplier', 'product', 'part')
+FORMATS = ('csv', 'jsonl', 'json')
+_MISSING = object()
+
+
+def Rows(textfile, fileformat='csv'):
+  """Yields the rows of an import file as dicts.
+
+  Arguments:
+    @ textfile: file
+      Text file object to read the rows from.
+    % fileformat: str ~~ 'csv'
+      csv with a header line, jsonl with an object per line, or json holding
+      a list of objects.
+  """
+  if fileformat == 'csv':
+    yield from csv.DictReader(textfile)
+  elif fileformat == 'jsonl':
+    for number, line in enumerate(textfile, 1):
+      if line.strip():
+        yield _Object(json.loads(line), number)
+  elif fileformat == 'json':
+    rows = json.load(textfile)
+    if not isinstance(rows, list):
+      raise ValueError('a json import holds a list of objects')
+    # Checked before the first row is imported.
+    yield from [_Object(row, number) for number, row in enumerate(rows, 1)]
+  else:
+    raise ValueError('Unknown import format %r, use one of %s' % (
+        fileformat, ', '.join(FORMATS)))
+
+
+def _Object(row, number):
+  """Returns the row, or raises ValueError when it is not a json object."""
+  if not isinstance(row, dict):
+    raise ValueError('row %d is not an object' % number)
+  return row
+
+
+class Importer:
+  """Imports suppliers, products and assembly parts in chunks.
+
+  Every row has a type column: supplier, product or part. Suppliers and
+  products are matched to existing records by name, parts by their product
+  and part names. Empty columns keep the existing value of a record, or get
+  the default for new records.
+
+  Rows are validated with the same rules the models apply before writing, and
+  checked for conflicts with existing products and with earlier rows. Each
+  chunk is then written with multi-row upserts in a single transaction. In a
+  dry run nothing is written, but the report holds the same counts and
+  conflicts.
+
+  Values that do not fit their database columns are reported per row. When
+  writing a chunk still fails, none of its rows are imported. The changes the
+  chunk made to the importer's own state are undone as well, so later chunks
+  are checked against what was actually written.
+  """
+  CHUNKSIZE = 1000
+  SUPPLIERFIELDS = ('name', 'website', 'telephone', 'contact_person',
+                    'email_address', 'gscode')
+  PRODUCTFIELDS = ('name', 'supplier', 'ean', 'gs1', 'sku', 'description',
+                   'cost', 'assemblycosts', 'vat', 'barcode')
+  PRODUCTDEFAULTS = {'supplier': 1, 'ean': None, 'gs1': None, 'sku': None,
+                     'description': '', 'cost': None, 'assemblycosts': 0,
+                     'vat': 21}
+  PARTFIELDS = ('ID', 'product', 'part', 'amount', 'assemblycosts')
+  # Ranges of values and largest lengths the columns of the database hold.
+  RANGES = {'cost': (-999.999, 999.999), 'assemblycosts': (-99.999, 99.999),
+            'vat': (-99.99, 99.99), 'gs1': (0, 65535), 'amount': (0, 65535)}
+  MAXLENGTHS = {'sku': 45, 'website': 255, 'telephone': 45,
+                'contact_person': 255, 'email_address': 255}
+
+  def __init__(self, connection, dryrun=False):
+    """Sets up the importer.
+
+    Arguments:
+      @ connection: sqltalk.connection
+        Database connection to use.
+      % dryrun: bool ~~ False
+        Validate and report, without writing anything.
+    """
+    self.connection = connection
+    self.dryrun = dryrun
+    self.report = {'dryrun': dryrun,
+                   'created': dict.fromkeys(KINDS, 0),
+                   'updated': dict.fromkeys(KINDS, 0),
+                   'errors': []}
+    # Rows already imported by this run, by kind and key.
+    self.imported = {kind: {} for kind in KINDS}
+    self.gs1s = {}
+    self.skus = {}
+    # Products by name, holding their ID (None for products that a dry run
+    # would create) and assemblycosts.
+    self.products = {}
+    # Parts added by this run, by product name.
+    self.edges = {}
+    # Previous values of the state changed by the current chunk.
+    self._undo = []
+    self._LoadSuppliers()
+
+  def _LoadSuppliers(self):
+    """Loads all suppliers, there are few enough to keep them by name."""
+    with self.connection as cursor:
+      suppliers = cursor.Select(table=model.Supplier.TableName(),
+                                conditions=[model.NOTDELETED])
+    self.suppliers = {row['name']: dict(row) for row in suppliers}
+
+  def Import(self, rows):
+    """Imports the rows and returns the report.
+
+    The report holds the number of created and updated records of each kind,
+    and an error for every row that was not imported.
+    """
+    chunk = []
+    for number, row in enumerate(rows, 1):
+      chunk.append((number, row))
+      if len(chunk) == self.CHUNKSIZE:
+        self._Chunk(chunk)
+        chunk = []
+    if chunk:
+      self._Chunk(chunk)
+    return self.report
+
+  def _Error(self, number, row, error):
+    self.report['errors'].append({'row': number,
+                                  'type': row.get('type'),
+                                  'name': row.get('name') or row.get('product'),
+                                  'error': str(error)})
+
+  def _Chunk(self, chunk):
+    """Validates and writes one chunk of rows in a single transaction."""
+    rows = {kind: [] for kind in KINDS}
+    for number, row in chunk:
+      kind = str(row.get('type') or '').strip().lower()
+      if kind in rows:
+        rows[kind].append((number, row))
+      else:
+        self._Error(number, row, 'Unknown row type, use one of %s' %
+                    ', '.join(KINDS))
+    counts = {'created': dict.fromkeys(KINDS, 0),
+              'updated': dict.fromkeys(KINDS, 0)}
+    self._undo = []
+    try:
+      with self.connection as cursor:
+        self._Suppliers(cursor, rows['supplier'], counts)
+        self._Products(cursor, rows['product'], counts)
+        self._Parts(cursor, rows['part'], counts)
+    except self.connection.Error as error:
+      # Integrity errors, but also values the columns cannot hold.
+      self._Error(chunk[0][0], chunk[0][1],
+                  'Rows %d to %d were not imported: %s' % (
+                      chunk[0][0], chunk[-1][0], error))
+      self._Undo()
+      self._LoadSuppliers()
+      return
+    for result, kinds in counts.items():
+      for kind, count in kinds.items():
+        self.report[result][kind] += count
+
+  def _Set(self, mapping, key, value):
+    """Sets mapping[key], remembering its old value to undo a failed chunk."""
+    self._undo.append((mapping, key, mapping.get(key, _MISSING)))
+    mapping[key] = value
+
+  def _Undo(self):
+    """Restores the imported, gs1s, skus, products and edges of the run to
+    their state before the current chunk."""
+    while self._undo:
+      mapping, key, value = self._undo.pop()
+      if value is _MISSING:
+        mapping.pop(key, None)
+      else:
+        mapping[key] = value
+
+  def _Duplicate(self, kind, key, number):
+    """Returns an error message if key was imported before, and records it."""
+    if key in self.imported[kind]:
+      return 'Duplicate %s, already imported on row %d' % (
+          kind, self.imported[kind][key])
+    self._Set(self.imported[kind], key, number)
+    return None
+
+  @staticmethod
+  def _Values(row, fields):
+    """Returns the non empty columns of the row that are in fields."""
+    values = {field: str(row.get(field)).strip() for field in fields
+              if row.get(field) is not None}
+    return {field: value for field, value in values.items() if value}
+
+  def _CheckLimits(self, record):
+    """Raises ValueError for values of the record that do not fit their
+    database columns."""
+    for field, (minimum, maximum) in self.RANGES.items():
+      if record.get(field) is not None and not minimum <= record[field] <= maximum:
+        raise ValueError('%s %s is out of range, use %s to %s' % (
+            field, record[field], minimum, maximum))
+    for field, length in self.MAXLENGTHS.items():
+      if record.get(field) is not None and len(str(record[field])) > length:
+        raise ValueError('%s is longer than %d characters' % (field, length))
+
+  def _Upsert(self, cursor, table, fields, records):
+    """Inserts or updates the records with a single multi-row statement."""
+    cursor.Execute('INSERT INTO `%s` (%s) VALUES %s ON DUPLICATE KEY UPDATE %s' % (
+        table,
+        ', '.join('`%s`' % field for field in fields),
+        ', '.join('(%s)' % ', '.join(self.connection.EscapeValues(record[field])
+                                     for field in fields)
+                  for record in records),
+        ', '.join('`%s` = VALUES(`%s`)' % (field, field)
+                  for field in fields if field != 'ID')))
+
+  def _Suppliers(self, cursor, rows, counts):
+    records = []
+    for number, row in rows:
+      values = self._Values(row, self.SUPPLIERFIELDS)
+      name = model.SanitizeName(values.get('name'), 45)
+      existing = self.suppliers.get(name)
+      supplier = dict.fromkeys(self.SUPPLIERFIELDS)
+      if existing:
+        supplier.update({field: existing[field] for field in self.SUPPLIERFIELDS})
+      supplier.update(values)
+      try:
+        model.Supplier.Sanitize(supplier)
+        self._CheckLimits(supplier)
+      except (ValueError, model.InvalidNameError) as error:
+        self._Error(number, row, error)
+        continue
+      error = self._Duplicate('supplier', supplier['name'], number)
+      if error:
+        self._Error(number, row, error)
+        continue
+      counts['updated' if existing else 'created']['supplier'] += 1
+      records.append(supplier)
+    if not records:
+      return
+    if self.dryrun:
+      for supplier in records:
+        # Products may refer to suppliers this run would create by name.
+        self.suppliers[supplier['name']] = dict(
+            self.suppliers.get(supplier['name'], {'ID': ('new', supplier['name'])}),
+            **supplier)
+      return
+    self._Upsert(cursor, model.Supplier.TableName(), self.SUPPLIERFIELDS, records)
+    for row in cursor.Select(
+        table=model.Supplier.TableName(),
+        conditions=['name in (%s)' % ', '.join(
+                        self.connection.EscapeValues(supplier['name'])
+                        for supplier in records),
+                    model.NOTDELETED]):
+      supplier = model.Supplier(self.connection, dict(row))
+      existing = self.suppliers.get(supplier['name'])
+      if existing and existing['gscode'] != supplier['gscode']:
+        supplier._UpdateBarcodes(cursor)
+      self.suppliers[supplier['name']] = dict(row)
+    model.Tableversion.Bump(cursor, model.Supplier.TableName())
+    model.Supplier._cache = None
+
+  def _Product(self, values, existing):
+    """Returns the product record for the imported values, or raises
+    ValueError for values that cannot be used."""
+    product = dict(self.PRODUCTDEFAULTS)
+    if existing:
+      product.update({field: existing[field] for field in self.PRODUCTFIELDS})
+    for field, convert in (('gs1', int), ('cost', float),
+                           ('assemblycosts', float), ('vat', float)):
+      if field in values:
+        try:
+          values[field] = convert(values[field])
+        except (TypeError, ValueError):
+          raise ValueError('Invalid %s %r' % (field, values[field]))
+    if 'ean' in values:
+      values['ean'] = str(values['ean'])
+      if not re.fullmatch(r'\d{1,13}', values['ean']):
+        raise ValueError('Invalid ean %r, use up to 13 digits' % values['ean'])
+    if 'supplier' in values:
+      supplier = self.suppliers.get(model.SanitizeName(values['supplier'], 45))
+      if not supplier:
+        raise ValueError('Unknown supplier %r' % values['supplier'])
+      values['supplier'] = supplier['ID']
+    product.update(values)
+    return product
+
+  def _Products(self, cursor, rows, counts):
+    candidates = []
+    for number, row in rows:
+      values = self._Values(row, self.PRODUCTFIELDS)
+      values['name'] = model.SanitizeName(values.get('name'), 255)
+      candidates.append((number, row, values))
+    if not candidates:
+      return
+    names = {values['name'] for _number, _row, values in candidates
+             if values['name']}
+    gs1s = {values['gs1'] for _number, _row, values in candidates
+            if str(values.get('gs1', '')).isdigit()}
+    skus = {values['sku'] for _number, _row, values in candidates
+            if values.get('sku')}
+    keys = ['name in (%s)' % ', '.join(self.connection.EscapeValues(name)
+                                       for name in names)] if names else []
+    if gs1s:
+      keys.append('gs1 in (%s)' % ', '.join(str(int(gs1)) for gs1 in gs1s))
+    if skus:
+      keys.append('sku in (%s)' % ', '.join(self.connection.EscapeValues(sku)
+                                            for sku in skus))
+    existing = {}
+    if keys:
+      for row in cursor.Select(table=model.Product.TableName(),
+                               conditions=['(%s)' % ' OR '.join(keys),
+                                           model.NOTDELETED]):
+        existing[row['name']] = dict(row)
+        if row['gs1'] and row['gs1'] not in self.gs1s:
+          self._Set(self.gs1s, row['gs1'], row['name'])
+        sku = (row['supplier'], row['sku'])
+        if row['sku'] and sku not in self.skus:
+          self._Set(self.skus, sku, row['name'])
+    gscodes = {supplier['ID']: supplier['gscode']
+               for supplier in self.suppliers.values()}
+
+    records = []
+    for number, row, values in candidates:
+      try:
+        product = self._Product(values, existing.get(values['name']))
+        model.Product.Sanitize(product)
+        self._CheckLimits(product)
+      except (ValueError, model.InvalidNameError) as error:
+        self._Error(number, row, error)
+        continue
+      error = self._Duplicate('product', product['name'], number)
+      if not error and self.gs1s.get(product['gs1'], product['name']) != product['name']:
+        error = 'gs1 %d is used by %s' % (product['gs1'], self.gs1s[product['gs1']])
+      sku = (product['supplier'], product['sku'])
+      if not error and self.skus.get(sku, product['name']) != product['name']:
+        error = 'sku %s of this supplier is used by %s' % (
+            product['sku'], self.skus[sku])
+      if error:
+        self._Error(number, row, error)
+        continue
+      if product['gs1']:
+        self._Set(self.gs1s, product['gs1'], product['name'])
+      if product['sku']:
+        self._Set(self.skus, sku, product['name'])
+      product['barcode'] = model.Product.Barcode(
+          product['ean'], product['gs1'], gscodes.get(product['supplier']))
+      counts['updated' if product['name'] in existing else 'created']['product'] += 1
+      records.append(product)
+      self._Set(self.products, product['name'], {
+          'ID': existing.get(product['name'], {}).get('ID'),
+          'assemblycosts': product['assemblycosts']})
+    if not records or self.dryrun:
+      return
+    self._Upsert(cursor, model.Product.TableName(), self.PRODUCTFIELDS, records)
+    written = cursor.Select(
+        table=model.Product.TableName(),
+        fields=('ID', 'name', 'description', 'sku'),
+        conditions=['name in (%s)' % ', '.join(
+                        self.connection.EscapeValues(product['name'])
+                        for product in records),
+                    model.NOTDELETED])
+    for row in written:
+      self._Set(self.products[row['name']], 'ID', row['ID'])
+    model.Productsearch.Index(cursor, [dict(row) for row in written])
+    model.Productcost.Invalidate(cursor, [row['ID'] for row in written])
+    model.Tableversion.Bump(cursor, model.Product.TableName())
+
+  def _LoadProducts(self, cursor, names):
+    """Adds the existing products with the given names to self.products."""
+    names = set(names) - set(self.products)
+    if not names:
+      return
+    for row in cursor.Select(table=model.Product.TableName(),
+                             fields=('ID', 'name', 'assemblycosts'),
+                             conditions=['name in (%s)' % ', '.join(
+                                             self.connection.EscapeValues(name)
+                                             for name in names),
+                                         model.NOTDELETED]):
+      self._Set(self.products, row['name'], {'ID': row['ID'],
+                                             'assemblycosts': row['assemblycosts']})
+
+  def _Contains(self, bom, name, searched):
+    """Returns whether the product called name is, or contains, searched."""
+    names = {productid: product['name']
+             for productid, product in bom.products.items()}
+    pending = [name]
+    seen = set()
+    while pending:
+      current = pending.pop()
+      if current == searched:
+        return True
+      if current in seen:
+        continue
+      seen.add(current)
+      pending.extend(self.edges.get(current, ()))
+      productid = self.products.get(current, {}).get('ID')
+      pending.extend(names[edge['part']] for edge in bom.edges.get(productid, ()))
+    return False
+
+  def _Parts(self, cursor, rows, counts):
+    candidates = []
+    for number, row in rows:
+      values = self._Values(row, ('product', 'part', 'amount', 'assemblycosts'))
+      for field in ('product', 'part'):
+        if field in values:
+          values[field] = model.SanitizeName(values[field], 255)
+      candidates.append((number, row, values))
+    if not candidates:
+      return
+    self._LoadProducts(cursor, (name for _number, _row, values in candidates
+                                for name in (values.get('product'),
+                                             values.get('part')) if name))
+    productids = {self.products[values['product']]['ID']
+                  for _number, _row, values in candidates
+                  if values.get('product') in self.products}
+    productids.discard(None)
+    partids = {self.products[values['part']]['ID']
+               for _number, _row, values in candidates
+               if values.get('part') in self.products}
+    if self.dryrun:
+      partids.update(self.products[name]['ID']
+                     for parts in self.edges.values() for name in parts)
+    partids.discard(None)
+    bom = model.BillOfMaterials(self.connection, partids, cursor=cursor)
+    existing = {}
+    if productids:
+      for row in cursor.Select(table=model.Productpart.TableName(),
+                               fields=('ID', 'product', 'part'),
+                               conditions='product in (%s)' % ', '.join(
+                                   str(productid) for productid in productids)):
+        existing[row['product'], row['part']] = row['ID']
+
+    records = []
+    for number, row, values in candidates:
+      product = self.products.get(values.get('product'))
+      part = self.products.get(values.get('part'))
+      error = None
+      if not product or not part:
+        error = 'Unknown product %r' % (
+            values.get('part') if product else values.get('product'))
+      elif values['product'] == values['part']:
+        error = 'A product cannot be a part of itself'
+      else:
+        error = self._Duplicate('part', (values['product'], values['part']), number)
+      if not error and self._Contains(bom, values['part'], values['product']):
+        error = '%s contains %s, it cannot be used as its part' % (
+            values['part'], values['product'])
+      if not error:
+        try:
+          amount = int(values.get('amount', 1))
+          assemblycosts = float(values.get('assemblycosts', part['assemblycosts']))
+          if amount < 1:
+            raise ValueError
+          self._CheckLimits({'amount': amount, 'assemblycosts': assemblycosts})
+        except (TypeError, ValueError):
+          error = 'Invalid amount or assemblycosts'
+      if error:
+        self._Error(number, row, error)
+        continue
+      self._Set(self.edges, values['product'],
+                self.edges.get(values['product'], set()) | {values['part']})
+      partid = existing.get((product['ID'], part['ID']))
+      counts['updated' if partid else 'created']['part'] += 1
+      records.append({'ID': partid,
+                      'product': product['ID'],
+                      'part': part['ID'],
+                      'amount': amount,
+                      'assemblycosts': assemblycosts})
+    if records and not self.dryrun:
+      self._Upsert(cursor, model.Productpart.TableName(), self.PARTFIELDS, records)
+      model.Productcost.Invalidate(cursor, {record['product'] for record in records})
@@ -6,32 +6,138 @@ __version__ = '1.0'
 
 # standard modules
 import datetime
+import decimal
+import hashlib
 import pytz
 import re
 import json
 import math
+import time
 
 # Custom modules
 from uweb3 import model
-from passlib.hash import pbkdf2_sha256
 import secrets
 
+# project modules
+from . import cache
+from . import hashing
+
 NOTDELETEDDATE = '1000-01-01 00:00:00'
 NOTDELETED = 'dateDeleted = "%s"' % NOTDELETEDDATE
 
+# Functions called with the set of IDs of products whose stock, parts or costs
+# changed in this process. Products using them as a part are only included when
+# their cost changed.
+PRODUCTLISTENERS = []
+
+
+def ProductsChanged(cursor, productids):
+  """Bumps the versions of the changed products, and calls the product
+  listeners with their IDs.
+
+  Arguments:
+    @ cursor: sqltalk.cursor
+      Cursor of the transaction that changes the products.
+    @ productids: set
+      IDs of the changed products.
+  """
+  Productversion.Bump(cursor, productids)
+  for listener in PRODUCTLISTENERS:
+    listener(productids)
+
+
+def Source(connection):
+  """Returns the name of the database the connection reads from. Caches keep
+  what was read from a replica apart, it may lag behind the primary."""
+  return getattr(connection, 'source', None)
+
+
+def SanitizeName(name, maxlength):
+  """Returns the name with spaces replaced by underscores, cut off at the first
+  character that is not allowed in names and at maxlength characters."""
+  if not name:
+    return name
+  match = re.search(r'([\w\-_\.,]+)', name.replace(' ', '_'))
+  return match.groups()[0][:maxlength] if match else ''
+
+
+def PrefetchForeign(connection, records, field, recordclass):
+  """Loads the foreign records referenced by a field of many records at once.
+
+  All referenced records are fetched with a single query and attached to the
+  given records, so reading the relation from a template does not trigger a
+  query per record.
+
+  Arguments:
+    @ connection: sqltalk.connection
+      Database connection to use.
+    @ records: iterable
+      Records that hold a foreign key in `field`.
+    @ field: str
+      Name of the field holding the foreign key.
+    @ recordclass: model.Record
+      The class of the referenced records.
+  """
+  pending = [record for record in records
+             if dict.get(record, field) is not None and
+             not isinstance(dict.get(record, field), model.Record)]
+  if not pending:
+    return
+  keys = {int(dict.get(record, field)) for record in pending}
+  with connection as cursor:
+    rows = cursor.Select(table=recordclass.TableName(),
+                         conditions=['`%s` in (%s)' % (
+                             recordclass._PRIMARY_KEY,
+                             ', '.join(str(key) for key in keys))])
+  related = {row[recordclass._PRIMARY_KEY]: recordclass(connection, row)
+             for row in rows}
+  for record in pending:
+    key = int(dict.get(record, field))
+    if key in related:
+      record[field] = related[key]
+
+
 class Product(model.Record):
   """Provides a model abstraction for the Product table"""
   _possiblestock = None
   _parts = None
   _products = None
+  _bom = None
 
   @classmethod
-  def List(cls, connection, conditions=[], *args, **kwargs):
-    """Returns the Products filtered on not deleted"""
-    return super().List(
+  def List(cls, connection, conditions=[], *args, prefetch=None, **kwargs):
+    """Returns the Products filtered on not deleted
+
+    Foreign relations named in `prefetch` are loaded for all products at once,
+    see Prefetch."""
+    products = super().List(
       connection,
       conditions=[NOTDELETED] + conditions,
       *args, **kwargs)
+    if not prefetch:
+      return products
+    products = list(products)
+    cls.Prefetch(connection,
+                 products[1:] if kwargs.get('yield_unlimited_total_first') else products,
+                 prefetch)
+    return products
+
+  @classmethod
+  def Prefetch(cls, connection, products, fields=('supplier',)):
+    """Loads the given foreign relations for many products at once.
+
+    Suppliers are served from the supplier cache."""
+    for field in fields:
+      if field == 'supplier':
+        for product in products:
+          if not isinstance(dict.get(product, 'supplier'), model.Record):
+            try:
+              product['supplier'] = Supplier.FromPrimary(
+                  connection, dict.get(product, 'supplier'))
+            except Supplier.NotExistError:
+              pass
+      else:
+        raise ValueError('Cannot prefetch %r for products.' % field)
 
   @classmethod
   def FromGS1(cls, connection, gs1, conditions=[]):
@@ -86,56 +192,105 @@ class Product(model.Record):
     return cls(connection, product[0])
 
   @classmethod
-  def EANSearch(cls, connection, ean=None, order=None, conditions=None, **kwargs):
+  def EANSearch(cls, connection, ean=None, order=None, conditions=None,
+                prefix=False, **kwargs):
     """Returns the products matching the searched (partial) EAN
 
+    The search runs on the stored barcode of the products, which is either
+    their own ean or the gscode of their supplier followed by their gs1 code.
+
       Arguments:
       @ connection: sqltalk.connection
         Database connection to use.
       % ean: str
-        Filters on ean or part of
+        Filters on the barcode, or its start when prefix is set
+      % prefix: bool ~~ False
+        Match barcodes that start with ean, for partial scans
     """
     if not conditions:
       conditions = []
-    queryorder = [('product.dateCreated', True)]
+    queryorder = [('dateCreated', True)]
     if order:
       queryorder = order + queryorder
-
-    return super().List(
+    ean = re.sub(r'\D', '', str(ean or ''))
+    if not ean:
+      condition = 'FALSE'
+    elif prefix:
+      condition = 'barcode LIKE "%s%%"' % ean
+    else:
+      condition = 'barcode = "%s"' % ean
+    return cls.List(
       connection,
-      conditions=["""( ean like "%%%d%%" or
-                       concat(supplier.gscode, LPAD(gs1, 3, 0)) like "%%%d%%") and
-                       product.supplier = supplier.ID and
-                       product.dateDeleted = "%s"
-                  """ %
-        (int(ean),
-         int(ean),
-         NOTDELETEDDATE)
-      ] + conditions,
+      conditions=[condition] + conditions,
       order=queryorder,
-      tables=('product', 'supplier'),
       **kwargs)
 
   @classmethod
-  def Search(cls, connection, query=None, order=None, conditions=None, **kwargs):
+  def Search(cls, connection, query=None, order=None, conditions=None,
+             limit=None, offset=0, yield_unlimited_total_first=False):
     """Returns the products matching the search
 
+    Every word in the query has to match the start of a word in the name,
+    description or sku of the product, using the productsearch index. Without
+    an explicit order, products that match whole words rank first.
+
       Arguments:
       @ connection: sqltalk.connection
         Database connection to use.
       % query: str
-        Filters on name
+        Filters on name, description and sku
+      % order: list
+        (field, descending) tuples to order on instead of the ranking
+      % conditions: list
+        Additional conditions on the product table
+      % limit: int
+        Maximum number of products to return
+      % offset: int
+        Number of matching products to skip
+      % yield_unlimited_total_first: bool
+        Yield the number of matching products before the products
     """
-    if not conditions:
-      conditions = []
-    queryorder = [('product.dateCreated', True)]
-    if order:
-      queryorder = order + queryorder
-    return cls.List(
-      connection,
-      conditions=['name like "%%%s%%"' % connection.EscapeValues(query)[1:-1]] + conditions,
-      order=queryorder,
-      **kwargs)
+    terms = sorted(set(Productsearch.Words(query or '')))
+    if not terms:
+      if yield_unlimited_total_first:
+        yield 0
+      return
+    # Words only hold letters and digits, so they need no quoting or escaping.
+    prefixes = ' OR '.join('word LIKE "%s%%"' % term for term in terms)
+    matched = ' '.join('WHEN word LIKE "%s%%" THEN %d' % (term, index)
+                       for index, term in enumerate(terms))
+    fromclause = """`%(product)s` AS product
+        JOIN (SELECT product,
+                     SUM(word IN (%(exact)s)) AS score,
+                     COUNT(DISTINCT CASE %(matched)s END) AS matched
+              FROM `%(search)s`
+              WHERE %(prefixes)s
+              GROUP BY product
+              HAVING matched = %(termcount)d) AS matches
+          ON matches.product = product.ID
+        WHERE %(conditions)s""" % {
+            'product': cls.TableName(),
+            'search': Productsearch.TableName(),
+            'exact': ', '.join('"%s"' % term for term in terms),
+            'matched': matched,
+            'prefixes': prefixes,
+            'termcount': len(terms),
+            'conditions': ' AND '.join(
+                '(%s)' % condition
+                for condition in ['product.%s' % NOTDELETED] + list(conditions or []))}
+    queryorder = ', '.join('%s %s' % (field, 'DESC' if descending else 'ASC')
+                           for field, descending in order or
+                           [('matches.score', True), ('product.ID', True)])
+    with connection as cursor:
+      if yield_unlimited_total_first:
+        total = cursor.Execute('SELECT COUNT(*) AS total FROM %s' % fromclause)
+      products = cursor.Execute('SELECT product.* FROM %s ORDER BY %s%s' % (
+          fromclause, queryorder,
+          ' LIMIT %d, %d' % (int(offset or 0), int(limit)) if limit else ''))
+    if yield_unlimited_total_first:
+      yield int(total[0]['total'])
+    for product in products:
+      yield cls(connection, product)
 
   @classmethod
   def FromName(cls, connection, name, conditions=None):
@@ -166,41 +321,145 @@ class Product(model.Record):
           'There is no product with common name %r' % name)
     return cls(connection, product[0])
 
+  @classmethod
+  def FromNames(cls, connection, names, conditions=None):
+    """Returns the products with the given common names.
+
+    Arguments:
+      @ connection: sqltalk.connection
+        Database connection to use.
+      @ names: iterable
+        The common names of the products.
+
+    Returns:
+      dict: Product abstraction classes keyed by name, names that do not exist
+            are left out.
+    """
+    names = set(names)
+    if not names:
+      return {}
+    if not conditions:
+      conditions = []
+    with connection as cursor:
+      products = cursor.Select(
+          table=cls.TableName(),
+          conditions=['name in (%s)' % ', '.join(
+                          connection.EscapeValues(name) for name in names),
+                      NOTDELETED] + conditions)
+    return {product['name']: cls(connection, product) for product in products}
+
+  @classmethod
+  def Lookup(cls, connection, names=(), barcodes=(), ids=()):
+    """Returns the products matching any of the given names, barcodes or IDs.
+
+    Arguments:
+      @ connection: sqltalk.connection
+        Database connection to use.
+      % names: iterable
+        Common names of products.
+      % barcodes: iterable
+        Barcodes (ean, or supplier gscode and gs1) of products.
+      % ids: iterable
+        IDs of products.
+
+    Returns:
+      list: Product abstraction classes, in no particular order.
+    """
+    keys = []
+    if names:
+      keys.append('name in (%s)' % ', '.join(
+          connection.EscapeValues(str(name)) for name in names))
+    if barcodes:
+      keys.append('barcode in (%s)' % ', '.join(
+          connection.EscapeValues(str(barcode)) for barcode in barcodes))
+    if ids:
+      keys.append('ID in (%s)' % ', '.join(str(int(key)) for key in ids))
+    if not keys:
+      return []
+    with connection as cursor:
+      products = cursor.Select(table=cls.TableName(),
+                               conditions=['(%s)' % ' OR '.join(keys),
+                                           NOTDELETED])
+    return [cls(connection, product) for product in products]
+
+  @classmethod
+  def Availability(cls, connection, products):
+    """Returns the current and possible stock of many products at once.
+
+    The bill of materials below all products is loaded as one graph, so the
+    number of queries does not depend on the number of products, and parts
+    shared between products are only computed once.
+
+    Arguments:
+      @ connection: sqltalk.connection
+        Database connection to use.
+      @ products: iterable
+        Product IDs (or Product records) to look up.
+
+    Returns:
+      dict: keyed by product ID, holding dicts with the currentstock and the
+            possiblestock, which is None for products that contain themselves.
+    """
+    productids = {int(product) for product in products}
+    bom = BillOfMaterials(connection, productids)
+    availability = {}
+    for productid in productids:
+      try:
+        possiblestock = bom.PossibleStock(productid)['available']
+      except AssemblyCycleError:
+        possiblestock = None
+      availability[productid] = {'currentstock': bom.stock[productid],
+                                 'possiblestock': possiblestock}
+    return availability
+
   def Delete(self):
     """Overwrites the default Delete and sets the dateDeleted datetime instead"""
     self['dateDeleted'] = str(pytz.utc.localize(
         datetime.datetime.utcnow()))[0:19]
     self.Save()
 
+  @staticmethod
+  def Sanitize(product):
+    """Cleans up the fields of a product (or a dict) before it is written.
+
+    Raises:
+      InvalidNameError: the product has no usable name.
+    """
+    product['name'] = SanitizeName(product.get('name'), 255)
+    if not product.get('gs1'): # set empty string to None for key contraints
+      product['gs1'] = None
+    if not product.get('sku'): # set empty string to None for key contraints
+      product['sku'] = None
+    if not product['name']:
+      raise InvalidNameError('Provide a valid name')
+
   def _PreCreate(self, cursor):
     super()._PreCreate(cursor)
-    if self['name']:
-      self['name'] = re.search('([\w\-_\.,]+)',
-          self['name'].replace(' ', '_')).groups()[0][:255]
-    if not self['gs1']: # set empty string to None for key contraints
-      self['gs1'] = None
-    if not self['sku']: # set empty string to None for key contraints
-      self['sku'] = None
-    if not self['name']:
-      raise InvalidNameError('Provide a valid name')
+    self.Sanitize(self)
+    self['barcode'] = self._Barcode(cursor)
 
   def _PreSave(self, cursor):
     super()._PreSave(cursor)
-    if self['name']:
-      self['name'] = re.search('([\w\-_\.,]+)',
-          self['name'].replace(' ', '_')).groups()[0][:255]
-    if not self['gs1']: # set empty string to None for key contraints
-      self['gs1'] = None
-    if not self['sku']: # set empty string to None for key contraints
-      self['sku'] = None
-    if not self['name']:
-      raise InvalidNameError('Provide a valid name')
+    self.Sanitize(self)
+    self['barcode'] = self._Barcode(cursor)
+
+  def _PostCreate(self, cursor):
+    super()._PostCreate(cursor)
+    Productsearch.Index(cursor, (self,))
+    Tableversion.Bump(cursor, self.TableName())
+
+  def _PostSave(self, cursor):
+    super()._PostSave(cursor)
+    Productsearch.Index(cursor, (self,))
+    Productcost.Invalidate(cursor, (self.key,))
+    Tableversion.Bump(cursor, self.TableName())
 
   @property
   def parts(self):
     """List products used as parts for this product"""
     if self._parts is None:
       self._parts = list(self._Children(Productpart))
+      Productpart.Prefetch(self.connection, self._parts, ('part',))
     return self._parts
 
   @property
@@ -208,6 +467,9 @@ class Product(model.Record):
     """List products that use this product as a part"""
     if self._products is None:
       self._products = list(self._Children(Productpart, relation_field="part"))
+      Productpart.Prefetch(self.connection, self._products, ('product',))
+      for part in self._products:
+        part['part'] = self
     return self._products
 
   def Stock(self, *args, **kwargs):
@@ -216,72 +478,44 @@ class Product(model.Record):
 
   @property
   def currentstock(self):
-    """Returns the current stock"""
-    with self.connection as cursor:
-      stock = cursor.Select(table=Stock.TableName(),
-                            fields='sum(amount) as currentstock',
-                            conditions=['product=%d' % self.key],
-                            escape=False)
-    if stock[0]['currentstock']:
-      return int(stock[0]['currentstock'])
-    return 0
+    """Returns the current stock, as maintained in the stockbalance table"""
+    return Stockbalance.ForProducts(self.connection, (self.key,))[self.key]
+
+  @property
+  def bom(self):
+    """Returns the bill of materials graph below this product"""
+    if self._bom is None:
+      self._bom = BillOfMaterials(self.connection, (self.key,))
+    return self._bom
 
   @property
   def possiblestock(self):
     """Returns the possible stock when using up currently available parts"""
-    if self._possiblestock:
-      return self._possiblestock
-
-    parts = list(self.parts)
-    if not parts:
-      self._possiblestock = {'available': 0,
-                             'parts': None,
-                             'limitedby': None}
-      return self._possiblestock
-
-    limitedby = parts[0]
-    availableassemblies = math.inf
-    for part in parts:
-      part['availablestock'] = part['part'].currentstock
-      part['availablepossiblestock'] = part['part'].possiblestock
-      if part['amount']:
-        part['availableassemblies'] = int((part['availablestock'] + part['availablepossiblestock']['available']) / part['amount'])
-        if part['availableassemblies'] < availableassemblies:
-          limitedby = part
-        availableassemblies = min(availableassemblies, part['availableassemblies'])
-
-    self._possiblestock = {'available': availableassemblies,
-                           'parts': parts,
-                           'limitedby': limitedby}
+    if self._possiblestock is None:
+      self._possiblestock = self.bom.PossibleStock(self.key)
+      if self._parts is None:
+        self._parts = self._possiblestock['parts'] or []
     return self._possiblestock
 
   def Assemble(self, amount=1, reference='Assembled from parts', lot=None):
-    """Tries to use up this products parts and assembles them, mutating stock on all products involved."""
-    if amount > 0:
-      possiblestock = self.possiblestock
-      if not possiblestock['available'] and not possiblestock['limitedby']:
-        raise AssemblyError('Cannot assemble this product, is not an assembled product.')
-      if not possiblestock['available'] or possiblestock['available'] < amount:
-        raise AssemblyError('Cannot assemble this product, not enough parts. Limited by: %s' % possiblestock['limitedby']['part']['name'])
-      parts = possiblestock['parts']
-    elif amount < 0:
-      if self.currentstock < abs(amount):
-        raise AssemblyError('Cannot Disassemble this product, not enough stock available.')
-      parts = list(self.parts)
-      if parts == 0:
-        raise AssemblyError('Cannot Disassemble this product, is not an assembled product.')
-
-    # Mutate parts one by one
-    for part in parts:
-      subreference = 'Assembly: %s, %s' % (self['name'], reference)
-      Stock.Create(self.connection, {'product': int(part['part']),
-                                     'amount': (part['amount'] * amount) * -1,
-                                     'reference': subreference[0:45]})
-    # Mutate this product as requested
-    return Stock.Create(self.connection, {'product': self.key,
-                                   'amount': amount,
-                                   'reference': reference[0:45] if reference else '',
-                                   'lot': lot})
+    """Tries to use up this products parts and assembles them, mutating stock on all products involved.
+
+    The stock balances of this product and all of its parts are locked while
+    the availability is checked and the mutations are written, so concurrent
+    assemblies cannot use up the same parts. Sub-assemblies are assembled from
+    their own parts where their stock falls short.
+
+    Returns:
+      list: the stock mutations that were written.
+    """
+    if not amount:
+      raise AssemblyError('Cannot assemble or disassemble zero products.')
+    with self.connection as cursor:
+      bom = BillOfMaterials(self.connection, (self.key,), cursor=cursor, lock=True)
+      mutations = bom.Assembly(self.key, amount, dict(bom.stock), reference, lot)
+      Stock.CreateMany(cursor, mutations)
+    self._possiblestock = self._bom = None
+    return mutations
 
   def Disassemble(self, amount=1, reference="Disassembled for parts", lot=None):
     """Remove as many assemblies as requested and create stock for parts"""
@@ -289,41 +523,1158 @@ class Product(model.Record):
                          reference or 'Disassembled for parts',
                          lot)
 
-  def AssemblyOptions(self):
-    partIds = []
-    for part in self.parts:
-      partIds.append(str(int(part['part'])))
-
-    return self.List(self.connection,
-        conditions=['ID != %d' % self.key,
-                    'ID not in (%s)' % ','.join(partIds) if partIds else 'true'])
+  def Ancestors(self):
+    """Returns the IDs of all products that use this product in their assembly."""
+    with self.connection as cursor:
+      return Productpart.Ancestors(cursor, (self.key,))
 
   @property
-  def Eancode(self):
-    if self['ean']:
-      return self['ean']
-    if self['gs1']:
+  def costs(self):
+    """Returns the material, assembly and total cost of this product, rolled
+    up over all levels of its bill of materials"""
+    return Productcost.ForProducts(self.connection, (self.key,)).get(self.key)
+
+  def PartOptions(self, query, limit=10):
+    """Returns the products matching the query that can be added as a part.
+
+    The product itself, its current parts and products that contain it (which
+    would make it a part of itself) are left out.
+
+    Arguments:
+      @ query: str
+        Words that should start the words in the name, description or sku.
+      % limit: int ~~ 10
+        Maximum number of products to return.
+    """
+    excluded = {self.key} | self.Ancestors()
+    excluded.update(int(part['part']) for part in self.parts if part['part'])
+    return list(self.Search(
+        self.connection, query=query, limit=limit,
+        conditions=['product.ID not in (%s)' % ', '.join(map(str, excluded))]))
+
+  @staticmethod
+  def Barcode(ean, gs1, gscode):
+    """Returns the barcode of a product: its ean, or the gscode of its supplier
+    followed by its gs1 code. Returns None when neither is available."""
+    if ean:
+      return str(ean)
+    if gs1:
       try:
-        return '%d%03d' % (int(self['supplier']['gscode']), self['gs1'])
-      except (KeyError, ValueError):
+        return '%d%03d' % (int(gscode), int(gs1))
+      except (TypeError, ValueError):
         return None
     return None
 
+  def _Barcode(self, cursor):
+    """Returns the barcode for the current ean, gs1 and supplier."""
+    if self.get('ean') or not self.get('gs1'):
+      return self.Barcode(self.get('ean'), None, None)
+    supplier = dict.get(self, 'supplier')
+    if isinstance(supplier, Supplier):
+      gscode = supplier['gscode']
+    else:
+      supplier = cursor.Select(table=Supplier.TableName(),
+                               fields=('gscode',),
+                               conditions='ID=%d' % int(supplier))
+      gscode = supplier[0]['gscode'] if supplier else None
+    return self.Barcode(None, self['gs1'], gscode)
+
+  @property
+  def Eancode(self):
+    return self.get('barcode')
+
+
+class Productsearch(model.Record):
+  """Provides a model abstraction for the productsearch table
+
+  The productsearch table holds every word of the name, description and sku
+  of each product, and is used by Product.Search to find products by word
+  prefixes with an index range scan.
+  """
+  WORDLENGTH = 64
+
+  @classmethod
+  def Words(cls, *texts):
+    """Returns the lowercased words in the given texts.
+
+    Words consist of letters and digits only, which makes them safe to use in
+    queries without escaping.
+    """
+    words = []
+    for text in texts:
+      if text:
+        words.extend(word[:cls.WORDLENGTH]
+                     for word in re.findall(r'[^\W_]+', str(text).lower()))
+    return words
+
+  @classmethod
+  def Index(cls, cursor, products):
+    """Replaces the indexed words of the given products.
+
+    Arguments:
+      @ cursor: sqltalk.cursor
+        Cursor of the transaction that writes the products.
+      @ products: iterable
+        Products (or dicts) holding at least ID, name, description and sku.
+    """
+    products = list(products)
+    if not products:
+      return
+    cursor.Execute('DELETE FROM `%s` WHERE product in (%s)' % (
+        cls.TableName(),
+        ', '.join(str(int(product['ID'])) for product in products)))
+    rows = ['("%s", %d)' % (word, int(product['ID']))
+            for product in products
+            for word in set(cls.Words(product.get('name'),
+                                      product.get('description'),
+                                      product.get('sku')))]
+    if rows:
+      cursor.Execute('INSERT IGNORE INTO `%s` (`word`, `product`) VALUES %s' % (
+          cls.TableName(), ', '.join(rows)))
+
+  @classmethod
+  def Rebuild(cls, connection, chunksize=1000):
+    """Reindexes all products, returns the number of products indexed."""
+    indexed = 0
+    lastid = 0
+    while True:
+      with connection as cursor:
+        products = cursor.Select(table=Product.TableName(),
+                                 fields=('ID', 'name', 'description', 'sku'),
+                                 conditions=['ID > %d' % lastid],
+                                 order=[('ID', False)],
+                                 limit=chunksize)
+        if not products:
+          return indexed
+        cls.Index(cursor, [dict(product) for product in products])
+      indexed += len(products)
+      lastid = products[-1]['ID']
+
+
+class BillOfMaterials:
+  """In-memory graph of the productpart relations below a set of products.
+
+  The graph is loaded with one query per level of the bill of materials, plus
+  one query each for the stock balances and the products involved. Possible
+  stock is then computed without further queries, and memoized per product so
+  parts shared by several sub-assemblies are only computed once.
+  """
+
+  def __init__(self, connection, products, cursor=None, lock=False):
+    """Loads the bill of materials below the given products.
+
+    Arguments:
+      @ connection: sqltalk.connection
+        Database connection to use.
+      @ products: iterable
+        Product IDs (or Product records) whose assemblies should be loaded.
+      % cursor: sqltalk.cursor ~~ None
+        Cursor of an ongoing transaction to load the graph in.
+      % lock: bool ~~ False
+        Lock the stock balances of all products in the graph until the end
+        of the transaction of the given cursor.
+    """
+    self.connection = connection
+    self.edges = {}
+    self.products = {}
+    self._records = None
+    self._possiblestock = {}
+    self._cost = {}
+    if cursor is None:
+      with connection as cursor:
+        self._Load(cursor, products, lock)
+    else:
+      self._Load(cursor, products, lock)
+
+  def _Load(self, cursor, products, lock):
+    pending = {int(product) for product in products}
+    while pending:
+      for productid in pending:
+        self.edges[productid] = []
+      edges = cursor.Select(
+          table=Productpart.TableName(),
+          conditions=['product in (%s)' % self._IdList(pending),
+                      'part is not null'])
+      for edge in edges:
+        self.edges[edge['product']].append(edge)
+      pending = {edge['part'] for edge in edges} - set(self.edges)
+    if self.edges:
+      for product in cursor.Select(
+          table=Product.TableName(),
+          conditions=['ID in (%s)' % self._IdList(self.edges)]):
+        self.products[product['ID']] = product
+    # Parts that no longer exist, or were deleted, are left out of assemblies.
+    for productid, edges in self.edges.items():
+      edges[:] = [edge for edge in edges if edge['part'] in self.products and
+                  str(self.products[edge['part']]['dateDeleted']) == NOTDELETEDDATE]
+    self.stock = Stockbalance.Select(cursor, self.edges, lock=lock)
+
+  @staticmethod
+  def _IdList(productids):
+    return ', '.join(str(int(productid)) for productid in productids)
+
+  def Product(self, productid):
+    """Returns the Product record for a product in the graph.
+
+    The records of all products in the graph are created on first use, and
+    their suppliers loaded at once."""
+    if self._records is None:
+      self._records = {key: Product(self.connection, dict(product))
+                       for key, product in self.products.items()}
+      Product.Prefetch(self.connection, self._records.values())
+    return self._records[productid]
+
+  def Descendants(self, productid):
+    """Returns the IDs of all products used in the given product's assembly."""
+    found = set()
+    pending = [productid]
+    while pending:
+      for edge in self.edges.get(pending.pop(), ()):
+        if edge['part'] not in found:
+          found.add(edge['part'])
+          pending.append(edge['part'])
+    return found
+
+  def PossibleStock(self, productid, _path=None):
+    """Returns the possible stock when using up currently available parts.
+
+    Arguments:
+      @ productid: int
+        ID of a product loaded into this graph.
+
+    Raises:
+      AssemblyCycleError:
+        The product is (indirectly) used as a part of itself.
+
+    Returns:
+      dict: with the keys 'available', the number of assemblies that can be
+            made, 'parts', the Productpart records of the assembly, and
+            'limitedby', the part that limits the available amount.
+    """
+    if productid in self._possiblestock:
+      return self._possiblestock[productid]
+    path = _path or []
+    if productid in path:
+      raise AssemblyCycleError('Product %s is used as a part of itself: %s' % (
+          self.products[productid]['name'],
+          ' > '.join(self.products[step]['name']
+                     for step in path[path.index(productid):] + [productid])))
+
+    edges = self.edges.get(productid)
+    if not edges:
+      self._possiblestock[productid] = {'available': 0,
+                                        'parts': None,
+                                        'limitedby': None}
+      return self._possiblestock[productid]
+
+    path.append(productid)
+    parts = []
+    availableassemblies = math.inf
+    for edge in edges:
+      part = Productpart(self.connection, dict(edge))
+      part['part'] = self.Product(edge['part'])
+      part['availablestock'] = self.stock[edge['part']]
+      part['availablepossiblestock'] = self.PossibleStock(edge['part'], path)
+      if part['amount']:
+        available = (part['availablestock'] +
+                     part['availablepossiblestock']['available'])
+        part['availableassemblies'] = (
+            available if available == math.inf else int(available / part['amount']))
+        if part['availableassemblies'] < availableassemblies:
+          limitedby = part
+        availableassemblies = min(availableassemblies, part['availableassemblies'])
+      parts.append(part)
+    path.pop()
+    if availableassemblies == math.inf:
+      limitedby = parts[0]
+
+    self._possiblestock[productid] = {'available': availableassemblies,
+                                      'parts': parts,
+                                      'limitedby': limitedby}
+    return self._possiblestock[productid]
+
+  def Cost(self, productid, _path=None):
+    """Returns the material and assembly cost of a product, over all levels.
+
+    The material cost of a product without parts is its cost; that of an
+    assembly is the material cost of its parts. The assembly cost adds up the
+    assembly costs of every part used, at every level.
+
+    Arguments:
+      @ productid: int
+        ID of a product loaded into this graph.
+
+    Raises:
+      AssemblyCycleError:
+        The product is (indirectly) used as a part of itself.
+
+    Returns:
+      dict: with the material, assembly and total cost.
+    """
+    if productid in self._cost:
+      return self._cost[productid]
+    path = _path or []
+    if productid in path:
+      raise AssemblyCycleError('Product %s is used as a part of itself: %s' % (
+          self.products[productid]['name'],
+          ' > '.join(self.products[step]['name']
+                     for step in path[path.index(productid):] + [productid])))
+    edges = self.edges.get(productid)
+    if not edges:
+      cost = decimal.Decimal(self.products[productid]['cost'] or 0)
+      self._cost[productid] = Productcost._Costs(cost, decimal.Decimal(0))
+      return self._cost[productid]
+    path.append(productid)
+    material = assembly = decimal.Decimal(0)
+    for edge in edges:
+      partcost = self.Cost(edge['part'], path)
+      material += edge['amount'] * partcost['material']
+      assembly += (edge['amount'] * partcost['assembly'] +
+                   decimal.Decimal(edge['assemblycosts']))
+    path.pop()
+    self._cost[productid] = Productcost._Costs(material, assembly)
+    return self._cost[productid]
+
+  def Assembly(self, productid, amount, stock,
+               reference='Assembled from parts', lot=None, _path=None):
+    """Returns the stock mutations that assemble a product from its parts.
+
+    Parts that are assemblies themselves are assembled from their own parts
+    when their stock falls short of what is needed.
+
+    Arguments:
+      @ productid: int
+        ID of a product loaded into this graph.
+      @ amount: int
+        Number of assemblies to make, negative to disassemble.
+      @ stock: dict
+        Current stock keyed by product ID, updated with the planned mutations.
+      % reference: str ~~ 'Assembled from parts'
+        Reference for the assembled product's stock mutation.
+      % lot: str ~~ None
+        Lot number for the assembled product's stock mutation.
+
+    Raises:
+      AssemblyError:
+        The product has no parts, or there is not enough stock to assemble or
+        disassemble the requested amount.
+
+    Returns:
+      list: stock mutation dicts, ready for Stock.CreateMany.
+    """
+    product = self.products[productid]
+    edges = self.edges.get(productid)
+    reference = reference or 'Assembled from parts'
+    path = _path or []
+    if productid in path:
+      raise AssemblyCycleError('Product %s is used as a part of itself.' % (
+          product['name']))
+    if not edges:
+      raise AssemblyError('Cannot %s this product, is not an assembled product.' %
+                          ('assemble' if amount > 0 else 'disassemble'))
+    if amount < 0 and stock[productid] < abs(amount):
+      raise AssemblyError('Cannot Disassemble this product, not enough stock available.')
+
+    mutations = []
+    subreference = ('Assembly: %s, %s' % (product['name'], reference))[0:45]
+    path.append(productid)
+    for edge in edges:
+      needed = edge['amount'] * amount
+      shortage = needed - max(stock[edge['part']], 0)
+      if amount > 0 and shortage > 0:
+        if not self.edges.get(edge['part']):
+          raise AssemblyError(
+              'Cannot assemble this product, not enough parts. Limited by: %s' %
+              self.products[edge['part']]['name'])
+        mutations.extend(self.Assembly(edge['part'], shortage, stock,
+                                       subreference, _path=path))
+      stock[edge['part']] -= needed
+      mutations.append({'product': edge['part'],
+                        'amount': needed * -1,
+                        'reference': subreference})
+    path.pop()
+    stock[productid] += amount
+    mutations.append({'product': productid,
+                      'amount': amount,
+                      'reference': reference[0:45],
+                      'lot': lot})
+    return mutations
+
 
 class Stock(model.Record):
   """Provides a model abstraction for the stock table"""
 
+  INSERTCHUNKSIZE = 500
+
+  @classmethod
+  def CreateMany(cls, cursor, mutations):
+    """Writes stock mutations with multi-row inserts, and updates the balances.
+
+    Arguments:
+      @ cursor: sqltalk.cursor
+        Cursor of the transaction to write the mutations in.
+      @ mutations: list
+        Dicts with the product, amount and optional reference and lot.
+    """
+    rows = [{'product': int(mutation['product']),
+             'amount': int(mutation['amount']),
+             'reference': (mutation.get('reference') or '')[0:45],
+             'lot': mutation.get('lot')} for mutation in mutations]
+    balances = {}
+    for row in rows:
+      balances[row['product']] = balances.get(row['product'], 0) + row['amount']
+    for offset in range(0, len(rows), cls.INSERTCHUNKSIZE):
+      cursor.Insert(table=cls.TableName(),
+                    values=rows[offset:offset + cls.INSERTCHUNKSIZE])
+    Stockbalance.Apply(cursor, balances)
+
+  EXPORTFIELDS = ('ID', 'dateCreated', 'product', 'sku', 'supplier',
+                  'amount', 'reference', 'lot')
+  EXPORTCHUNKSIZE = 1000
+
+  @classmethod
+  def Export(cls, connection, product=None, supplier=None, start=None,
+             end=None, lot=None):
+    """Yields the stock ledger as dicts with the EXPORTFIELDS, oldest first.
+
+    The ledger is read in chunks, seeking on the primary key, so memory use
+    does not depend on the number of exported rows. Rows written after the
+    export started are left out, which keeps the export consistent.
+
+    Arguments:
+      % product: int
+        Only export the mutations of this product.
+      % supplier: int
+        Only export the mutations of products from this supplier.
+      % start: str
+        Only export mutations from this date (YYYY-MM-DD) on.
+      % end: str
+        Only export mutations before this date (YYYY-MM-DD).
+      % lot: str
+        Only export mutations for this lot.
+    """
+    conditions = []
+    if product is not None:
+      conditions.append('stock.product = %d' % int(product))
+    if supplier is not None:
+      conditions.append('product.supplier = %d' % int(supplier))
+    if start:
+      conditions.append('stock.dateCreated >= %s' % connection.EscapeValues(
+          str(datetime.datetime.strptime(start, '%Y-%m-%d'))))
+    if end:
+      conditions.append('stock.dateCreated < %s' % connection.EscapeValues(
+          str(datetime.datetime.strptime(end, '%Y-%m-%d'))))
+    if lot:
+      conditions.append('stock.lot = %s' % connection.EscapeValues(lot))
+    with connection as cursor:
+      lastid = cursor.Execute('SELECT MAX(ID) AS lastid FROM `%s`' %
+                              cls.TableName())[0]['lastid'] or 0
+    currentid = 0
+    while currentid < lastid:
+      with connection as cursor:
+        rows = cursor.Execute("""
+            SELECT stock.ID, stock.dateCreated, product.name AS product,
+                   product.sku, supplier.name AS supplier, stock.amount,
+                   stock.reference, stock.lot
+            FROM `%s` AS stock
+            JOIN `%s` AS product ON product.ID = stock.product
+            LEFT JOIN `%s` AS supplier ON supplier.ID = product.supplier
+            WHERE stock.ID > %d AND stock.ID <= %d%s
+            ORDER BY stock.ID
+            LIMIT %d""" % (
+                cls.TableName(), Product.TableName(), Supplier.TableName(),
+                currentid, lastid,
+                ''.join(' AND %s' % condition for condition in conditions),
+                cls.EXPORTCHUNKSIZE))
+      if not rows:
+        return
+      for row in rows:
+        yield {field: row[field] for field in cls.EXPORTFIELDS}
+      currentid = rows[-1]['ID']
+
+  @classmethod
+  def Batch(cls, connection, lines):
+    """Processes many stock mutations, assembling products where needed.
+
+    Products are looked up by name in one query, availability is checked
+    against the bill of materials of all products at once, and all resulting
+    mutations are written in a single transaction. A line that cannot be
+    processed does not prevent the other lines from being written.
+
+    Arguments:
+      @ connection: sqltalk.connection
+        Database connection to use.
+      @ lines: list
+        Dicts with the product name, the amount (negative to sell, assembling
+        the product if there is not enough stock) and an optional reference
+        and lot.
+
+    Returns:
+      list: one result dict per line, holding either the new stock for the
+            product or the error that prevented the mutation.
+    """
+    products = Product.FromNames(connection,
+                                 {str(line.get('product')) for line in lines})
+    with connection as cursor:
+      bom = BillOfMaterials(connection, products.values(), cursor=cursor, lock=True)
+      results, mutations = cls._BatchMutations(bom, products, lines)
+      if mutations:
+        cls.CreateMany(cursor, mutations)
+    return results
+
+  @staticmethod
+  def _BatchMutations(bom, products, lines):
+    """Plans the stock mutations for Batch, returns the results and mutations."""
+    stock = dict(bom.stock)
+    mutations = []
+    results = []
+    for line in lines:
+      name = str(line.get('product'))
+      if name not in products:
+        results.append({'product': name,
+                        'error': 'There is no product with common name %r' % name})
+        continue
+      productid = products[name].key
+      try:
+        amount = int(line.get('amount', -1))
+      except (TypeError, ValueError):
+        results.append({'product': name, 'error': 'Invalid amount.'})
+        continue
+      reference = line.get('reference') or ''
+      linestock = dict(stock)
+      linemutations = []
+      if amount < 0 and abs(amount) > linestock[productid]:
+        try:
+          linemutations = bom.Assembly(
+              productid, abs(amount) - linestock[productid], linestock,
+              'Assembly for %s' % reference if reference else None)
+        except AssemblyError as error:
+          results.append({'product': name, 'error': str(error)})
+          continue
+      linestock[productid] += amount
+      linemutations.append({'product': productid,
+                            'amount': amount,
+                            'reference': reference,
+                            'lot': line.get('lot')})
+      stock = linestock
+      mutations.extend(linemutations)
+      results.append({'product': name,
+                      'amount': amount,
+                      'currentstock': stock[productid]})
+    return results, mutations
+
+  def _PostCreate(self, cursor):
+    """Adds this mutation to the product's stock balance.
+
+    This runs on the cursor of the Create call, so the ledger row and the
+    balance are committed in the same transaction.
+    """
+    super()._PostCreate(cursor)
+    Stockbalance.Apply(cursor, {int(self['product']): int(self['amount'])})
+
+
+class Stockbalance(model.Record):
+  """Provides a model abstraction for the stockbalance table
+
+  The stockbalance table holds the sum of the stock ledger for each product,
+  and is updated for every row written to the stock table.
+  """
+  _PRIMARY_KEY = 'product'
+
+  @classmethod
+  def Apply(cls, cursor, mutations):
+    """Adds the given mutations to the stock balances.
+
+    Arguments:
+      @ cursor: sqltalk.cursor
+        Cursor of the transaction that writes the stock ledger rows.
+      @ mutations: dict
+        Amount to add to the balance, keyed by product ID.
+    """
+    values = ', '.join('(%d, %d)' % (int(product), int(amount))
+                       for product, amount in mutations.items() if amount)
+    if not values:
+      return
+    cursor.Execute("""INSERT INTO `%s` (`product`, `amount`)
+                      VALUES %s
+                      ON DUPLICATE KEY UPDATE `amount` = `amount` + VALUES(`amount`)
+                   """ % (cls.TableName(), values))
+    # Only the products themselves, assemblies include the versions of their
+    # parts in their own, see Productversion.FromName.
+    ProductsChanged(cursor, {int(product) for product in mutations})
+
+  @classmethod
+  def ForProducts(cls, connection, products):
+    """Returns the current stock for the given products.
+
+    Arguments:
+      @ connection: sqltalk.connection
+        Database connection to use.
+      @ products: iterable
+        Product IDs (or Product records) to look up.
+
+    Returns:
+      dict: current stock keyed by product ID, 0 for products without stock.
+    """
+    with connection as cursor:
+      return cls.Select(cursor, products)
+
+  @classmethod
+  def Select(cls, cursor, products, lock=False):
+    """Returns the current stock for the given products within a transaction.
+
+    Arguments:
+      @ cursor: sqltalk.cursor
+        Cursor of the transaction to read the balances in.
+      @ products: iterable
+        Product IDs (or Product records) to look up.
+      % lock: bool ~~ False
+        Lock the balances until the end of the transaction, creating them
+        where needed so products without any stock are locked too.
+
+    Returns:
+      dict: current stock keyed by product ID, 0 for products without stock.
+    """
+    productids = sorted({int(product) for product in products})
+    balances = dict.fromkeys(productids, 0)
+    if not productids:
+      return balances
+    idlist = ', '.join(str(productid) for productid in productids)
+    if lock:
+      cursor.Execute('INSERT IGNORE INTO `%s` (`product`, `amount`) VALUES %s' % (
+          cls.TableName(),
+          ', '.join('(%d, 0)' % productid for productid in productids)))
+      rows = cursor.Execute("""SELECT product, amount FROM `%s`
+                               WHERE product in (%s)
+                               ORDER BY product FOR UPDATE""" % (
+                                   cls.TableName(), idlist))
+    else:
+      rows = cursor.Select(table=cls.TableName(),
+                           fields='product, amount',
+                           conditions=['product in (%s)' % idlist],
+                           escape=False)
+    for row in rows:
+      balances[row['product']] = int(row['amount'])
+    return balances
+
+  @classmethod
+  def Reconcile(cls, connection, repair=False):
+    """Compares the stock balances against the sum of the stock ledger.
+
+    Arguments:
+      @ connection: sqltalk.connection
+        Database connection to use.
+      % repair: bool ~~ False
+        Overwrite mismatching balances with the ledger sum.
+
+    Returns:
+      list: dicts with the product, ledger sum and balance for every product
+            where the two differ.
+    """
+    with connection as cursor:
+      mismatches = list(cursor.Execute("""
+          SELECT ledger.product, ledger.amount AS ledger,
+                 IFNULL(balance.amount, 0) AS balance
+          FROM (SELECT product, SUM(amount) AS amount
+                FROM `%(stock)s` GROUP BY product) AS ledger
+          LEFT JOIN `%(balance)s` AS balance ON balance.product = ledger.product
+          WHERE IFNULL(balance.amount, 0) != ledger.amount
+          UNION ALL
+          SELECT balance.product, 0 AS ledger, balance.amount AS balance
+          FROM `%(balance)s` AS balance
+          WHERE balance.amount != 0 AND
+                NOT EXISTS (SELECT 1 FROM `%(stock)s` AS stock
+                            WHERE stock.product = balance.product)
+          """ % {'stock': Stock.TableName(), 'balance': cls.TableName()}))
+    mismatches = [{'product': int(row['product']),
+                   'ledger': int(row['ledger']),
+                   'balance': int(row['balance'])} for row in mismatches]
+    if repair and mismatches:
+      with connection as cursor:
+        mismatches = cls._Repair(cursor, [row['product'] for row in mismatches])
+    return mismatches
+
+  @classmethod
+  def _Repair(cls, cursor, products):
+    """Overwrites the balances of the given products with their ledger sum.
+
+    The balances are locked before the ledger is summed, so a stock mutation
+    for these products waits until the repair is committed, and is then added
+    to the repaired balance. The ledger is read with a locking read, which
+    sees every mutation committed before the balances were locked.
+
+    Returns:
+      list: the mismatches that were repaired.
+    """
+    balances = cls.Select(cursor, products, lock=True)
+    ledger = dict.fromkeys(balances, 0)
+    for row in cursor.Execute("""SELECT product, SUM(amount) AS amount
+                                 FROM `%s`
+                                 WHERE product in (%s)
+                                 GROUP BY product
+                                 LOCK IN SHARE MODE""" % (
+                                     Stock.TableName(),
+                                     ', '.join(map(str, balances)))):
+      ledger[int(row['product'])] = int(row['amount'])
+    mismatches = [{'product': product,
+                   'ledger': ledger[product],
+                   'balance': balances[product]}
+                  for product in sorted(balances)
+                  if ledger[product] != balances[product]]
+    if mismatches:
+      cursor.Execute("""INSERT INTO `%s` (`product`, `amount`)
+                        VALUES %s
+                        ON DUPLICATE KEY UPDATE `amount` = VALUES(`amount`)
+                     """ % (cls.TableName(), ', '.join(
+                         '(%d, %d)' % (row['product'], row['ledger'])
+                         for row in mismatches)))
+    return mismatches
+
+  @classmethod
+  def Rebuild(cls, connection):
+    """Replaces all stock balances with the sums from the stock ledger."""
+    with connection as cursor:
+      cursor.Execute('DELETE FROM `%s`' % cls.TableName())
+      cursor.Execute("""INSERT INTO `%s` (`product`, `amount`)
+                        SELECT product, SUM(amount) FROM `%s` GROUP BY product
+                     """ % (cls.TableName(), Stock.TableName()))
+
 
 class Productpart(model.Record):
   """Provides a model abstraction for the Productpart table"""
   _FOREIGN_RELATIONS = {'part': Product}
 
+  @classmethod
+  def Prefetch(cls, connection, parts, fields=('part',)):
+    """Loads the given products of many productparts in one query each, along
+    with the suppliers of those products."""
+    for field in fields:
+      PrefetchForeign(connection, parts, field, Product)
+    Product.Prefetch(connection, [dict.get(part, field)
+                                  for part in parts for field in fields
+                                  if isinstance(dict.get(part, field), Product)])
+
+  @classmethod
+  def Descendants(cls, cursor, products):
+    """Returns the IDs of all products used in the assembly of any of the
+    given products, with one query per level of the bill of materials."""
+    found = set()
+    pending = {int(product) for product in products}
+    while pending:
+      rows = cursor.Select(
+          table=cls.TableName(),
+          fields=('part',),
+          conditions=['product in (%s)' % ', '.join(map(str, pending)),
+                      'part is not null'])
+      pending = {row['part'] for row in rows} - found
+      found |= pending
+    return found
+
+  @classmethod
+  def Ancestors(cls, cursor, products):
+    """Returns the IDs of all products that use any of the given products in
+    their assembly, with one query per level of the bill of materials."""
+    found = set()
+    pending = {int(product) for product in products}
+    while pending:
+      rows = cursor.Select(
+          table=cls.TableName(),
+          fields=('product',),
+          conditions='part in (%s)' % ', '.join(map(str, pending)))
+      pending = {row['product'] for row in rows} - found
+      found |= pending
+    return found
+
+  def _PostCreate(self, cursor):
+    super()._PostCreate(cursor)
+    self._Invalidate(cursor)
+
+  def _PostSave(self, cursor):
+    super()._PostSave(cursor)
+    self._Invalidate(cursor)
+
+  def Delete(self):
+    """Deletes the part, and the stored costs of the products using it, in
+    one transaction."""
+    with self.connection as cursor:
+      cursor.Execute('DELETE FROM `%s` WHERE `ID` = %d' % (
+          self.TableName(), self.key))
+      self._Invalidate(cursor)
+
+  def _Invalidate(self, cursor):
+    """Removes the stored costs of the assembly and the products using it, and
+    bumps the version of the part, whose list of assemblies changed."""
+    Productcost.Invalidate(cursor, (int(self['product']),))
+    ProductsChanged(cursor, {int(dict.get(self, 'part'))})
+
   @property
   def subtotal(self):
-    return (self['amount'] * self['part']['cost']) + self['assemblycosts']
+    """Returns the cost of the parts, using the rolled up unitcost of the part
+    when it was added, and the assembly costs"""
+    unitcost = self.get('unitcost', self['part']['cost'])
+    return (self['amount'] * (unitcost or 0)) + self['assemblycosts']
+
+
+class Productcost(model.Record):
+  """Provides a model abstraction for the productcost table
+
+  The productcost table stores the cost of products rolled up over all levels
+  of their bill of materials. Rows are computed when they are first read, and
+  removed when the cost of a product or one of its parts changes.
+
+  Changes bump the versions of the changed products before removing costs. A
+  computed cost is only stored when the versions of the products in its bill
+  of materials did not change while it was computed, so a cost removed in the
+  meantime is not stored again.
+  """
+  _PRIMARY_KEY = 'product'
+
+  @classmethod
+  def ForProducts(cls, connection, products, store=True):
+    """Returns the rolled up costs of the given products.
+
+    Stored costs are read with one query. The costs of the other products
+    are computed in a single pass over their combined bill of materials, and
+    stored for every product in that graph.
+
+    Arguments:
+      @ connection: sqltalk.connection
+        Database connection to use.
+      @ products: iterable
+        Product IDs (or Product records) to look up.
+      % store: bool ~~ True
+        Store the computed costs. Costs computed on a read replica are not
+        stored, the replica may not have the latest parts and prices yet.
+
+    Returns:
+      dict: keyed by product ID, holding dicts with the material, assembly
+            and total cost. Products that are (indirectly) used as a part of
+            themselves have no cost, and are left out.
+    """
+    productids = {int(product) for product in products}
+    if not productids:
+      return {}
+    with connection as cursor:
+      costs = {row['product']: cls._Costs(row['material'], row['assembly'])
+               for row in cursor.Select(
+                   table=cls.TableName(),
+                   conditions='product in (%s)' % ', '.join(map(str, productids)))}
+    missing = productids - set(costs)
+    if missing:
+      with connection as cursor:
+        # One transaction, so the versions match the parts and prices read.
+        bom = BillOfMaterials(connection, missing, cursor=cursor)
+        versions = Productversion.Current(cursor, bom.products) if store else {}
+      computed = {}
+      for productid in bom.products:
+        try:
+          computed[productid] = bom.Cost(productid)
+        except AssemblyCycleError:
+          pass
+      if computed and store:
+        cls._Store(connection, computed, bom, versions)
+      costs.update((productid, computed[productid]) for productid in missing
+                   if productid in computed)
+    return costs
+
+  @classmethod
+  def _Store(cls, connection, computed, bom, versions):
+    """Stores the computed costs whose bill of materials still has the given
+    versions. The versions are locked until the costs are stored, so a change
+    to them waits for the store, and then removes the stored costs."""
+    with connection as cursor:
+      current = Productversion.Current(cursor, bom.products, lock=True)
+      changed = {productid for productid in bom.products
+                 if current.get(productid) != versions.get(productid)}
+      computed = {productid: cost for productid, cost in computed.items()
+                  if productid not in changed and
+                  not bom.Descendants(productid) & changed}
+      if not computed:
+        return
+      cursor.Execute("""INSERT INTO `%s` (`product`, `material`, `assembly`)
+                        VALUES %s
+                        ON DUPLICATE KEY UPDATE
+                          `material` = VALUES(`material`),
+                          `assembly` = VALUES(`assembly`)""" % (
+          cls.TableName(),
+          ', '.join('(%d, %s, %s)' % (productid, cost['material'], cost['assembly'])
+                    for productid, cost in computed.items())))
+
+  @staticmethod
+  def _Costs(material, assembly):
+    return {'material': material,
+            'assembly': assembly,
+            'total': material + assembly}
+
+  @classmethod
+  def Invalidate(cls, cursor, products):
+    """Removes the stored costs of the given products and of every product
+    that uses them as a part.
+
+    Arguments:
+      @ cursor: sqltalk.cursor
+        Cursor of the transaction that changes the costs.
+      @ products: iterable
+        IDs of the products whose cost or parts changed.
+    """
+    productids = {int(product) for product in products}
+    if not productids:
+      return
+    productids |= Productpart.Ancestors(cursor, productids)
+    # Bumped first, this waits for a concurrent _Store of these products.
+    ProductsChanged(cursor, productids)
+    cursor.Execute('DELETE FROM `%s` WHERE product in (%s)' % (
+        cls.TableName(), ', '.join(map(str, productids))))
+
+class Productversion(model.Record):
+  """Provides a model abstraction for the productversion table
+
+  The productversion table holds a version per product, bumped whenever the
+  product, its parts, its cost or its stock change. A stock change only bumps
+  the product itself, the version of an assembly's response covers the
+  versions of all products in its bill of materials, see FromName.
+  """
+  _PRIMARY_KEY = 'product'
+
+  @classmethod
+  def Bump(cls, cursor, products):
+    """Increments the versions of the given products.
+
+    Arguments:
+      @ cursor: sqltalk.cursor
+        Cursor of the transaction that changes the products.
+      @ products: iterable
+        IDs of the changed products.
+    """
+    productids = sorted({int(product) for product in products})
+    if not productids:
+      return
+    cursor.Execute("""INSERT INTO `%s` (`product`, `version`) VALUES %s
+                      ON DUPLICATE KEY UPDATE `version` = `version` + 1
+                   """ % (cls.TableName(),
+                          ', '.join('(%d, 1)' % productid for productid in productids)))
+
+  @classmethod
+  def Current(cls, cursor, products, lock=False):
+    """Returns the versions of the given products, by product ID. Products
+    that were never changed have no version, and are left out.
+
+    Arguments:
+      @ cursor: sqltalk.cursor
+        Cursor of the transaction to read the versions in.
+      @ products: iterable
+        Product IDs to look up.
+      % lock: bool ~~ False
+        Lock the versions against changes until the end of the transaction.
+    """
+    productids = sorted({int(product) for product in products})
+    if not productids:
+      return {}
+    rows = cursor.Execute("""SELECT product, version FROM `%s`
+                             WHERE product in (%s)%s""" % (
+        cls.TableName(), ', '.join(map(str, productids)),
+        ' LOCK IN SHARE MODE' if lock else ''))
+    return {row['product']: row['version'] for row in rows}
+
+  @classmethod
+  def FromName(cls, connection, name):
+    """Returns the ID of the named product, and the version of its responses,
+    without loading the product itself.
+
+    The version is a digest of the versions of the product and of all products
+    in its bill of materials, so it changes when any of them changes.
+
+    Raises:
+      NotExistError:
+        The given product name does not exist.
+    """
+    with connection as cursor:
+      rows = cursor.Select(table=Product.TableName(),
+                           fields=('ID',),
+                           conditions=['name = %s' % connection.EscapeValues(name),
+                                       NOTDELETED])
+      if not rows:
+        raise Product.NotExistError(
+            'There is no product with common name %r' % name)
+      productid = rows[0]['ID']
+      products = {productid} | Productpart.Descendants(cursor, (productid,))
+      versions = cls.Current(cursor, products)
+    return productid, hashlib.sha1(repr(sorted(
+        (product, versions.get(product, 0)) for product in products)).encode(
+            'utf-8')).hexdigest()[:16]
+
+
+class Tableversion(model.Record):
+  """Provides a model abstraction for the tableversion table
+
+  Each table that is cached by the application has its write version stored
+  here. Writes bump the version in their own transaction, so other processes
+  can see that their cached copy is stale with a single primary key lookup.
+  """
+  _PRIMARY_KEY = 'tablename'
+
+  @classmethod
+  def Bump(cls, cursor, tablename):
+    """Increments the write version of the given table."""
+    cursor.Execute("""INSERT INTO `%s` (`tablename`, `version`) VALUES ("%s", 1)
+                      ON DUPLICATE KEY UPDATE `version` = `version` + 1
+                   """ % (cls.TableName(), tablename))
+
+  @classmethod
+  def Current(cls, connection, tablenames):
+    """Returns the write versions of the given tables, keyed by table name."""
+    versions = dict.fromkeys(tablenames, 0)
+    with connection as cursor:
+      rows = cursor.Select(table=cls.TableName(),
+                           conditions=['tablename in (%s)' % ', '.join(
+                               connection.EscapeValues(tablename)
+                               for tablename in versions)])
+    for row in rows:
+      versions[row['tablename']] = row['version']
+    return versions
+
+
+class CountCache:
+  """Caches the total counts of listings.
+
+  Counts are keyed by the listing and its arguments, together with the write
+  versions of the tables involved, so any write to those tables makes the
+  cached count stale. Counts from a replica are kept apart. Estimated counts are read from the table statistics.
+  """
+
+  def __init__(self, maxsize=512, ttl=600, estimatettl=60):
+    self.counts = cache.LRUCache(maxsize=maxsize, ttl=ttl)
+    self.estimates = cache.LRUCache(maxsize=64, ttl=estimatettl)
+
+  def Count(self, connection, tablenames, key, counter):
+    """Returns the cached count for key, calling counter when it is stale.
+
+    Arguments:
+      @ connection: sqltalk.connection
+        Database connection to use.
+      @ tablenames: iterable
+        The tables the counted query reads from.
+      @ key: hashable
+        Identifies the listing and its arguments.
+      @ counter: function
+        Returns the exact count, called without arguments.
+    """
+    versions = Tableversion.Current(connection, tablenames)
+    key = (key, Source(connection), tuple(sorted(versions.items())))
+    count = self.counts.Get(key)
+    if count is None:
+      count = counter()
+      self.counts.Set(key, count)
+    return count
+
+  def Estimate(self, connection, tablename):
+    """Returns the estimated number of rows in a table, from its statistics."""
+    count = self.estimates.Get(tablename)
+    if count is None:
+      with connection as cursor:
+        rows = cursor.Select(table='information_schema.TABLES',
+                             fields='TABLE_ROWS',
+                             conditions=['TABLE_SCHEMA = DATABASE()',
+                                         'TABLE_NAME = %s' % connection.EscapeValues(tablename)],
+                             escape=False)
+      count = int(rows[0]['TABLE_ROWS'] or 0) if rows else 0
+      self.estimates.Set(tablename, count)
+    return count
+
+
+COUNTCACHE = CountCache()
+
 
 class Supplier(model.Record):
-  """Provides a model abstraction for the Supplier table"""
+  """Provides a model abstraction for the Supplier table
+
+  All suppliers are cached in each process. The cache is checked against the
+  supplier write version in the tableversion table at most once every
+  CACHECHECKINTERVAL seconds, and dropped right away by writes from this
+  process. Suppliers read from a replica are cached apart from those read from
+  the primary.
+  """
+  CACHECHECKINTERVAL = 1
+  _cache = None
+
+  @classmethod
+  def _Cache(cls, connection):
+    """Returns the supplier cache for the connection's database, reloading it
+    if the table has changed."""
+    caches = cls._cache or {}
+    cache = caches.get(Source(connection))
+    now = time.monotonic()
+    if cache and now - cache['checked'] < cls.CACHECHECKINTERVAL:
+      return cache
+    version = Tableversion.Current(connection, (cls.TableName(),))[cls.TableName()]
+    if not cache or cache['version'] != version:
+      with connection as cursor:
+        rows = cursor.Select(table=cls.TableName(), order=[('ID', False)])
+      cache = {'version': version,
+               'byid': {row['ID']: dict(row) for row in rows},
+               'byname': {row['name']: dict(row) for row in rows
+                          if str(row['dateDeleted']) == NOTDELETEDDATE}}
+    cache['checked'] = now
+    cls._cache = {**caches, Source(connection): cache}
+    return cache
+
+  @classmethod
+  def All(cls, connection):
+    """Returns all suppliers that are not deleted, from the cache."""
+    return [cls(connection, dict(row))
+            for row in cls._Cache(connection)['byname'].values()]
+
+  @classmethod
+  def FromPrimary(cls, connection, pkey_value):
+    """Returns the supplier with the given ID, from the cache.
+
+    Raises:
+      NotExistError:
+        There is no supplier with the given ID.
+    """
+    try:
+      row = cls._Cache(connection)['byid'][int(pkey_value)]
+    except (KeyError, TypeError, ValueError):
+      raise cls.NotExistError(
+          'There is no supplier with primary key %r' % pkey_value)
+    return cls(connection, dict(row))
+
+  def _PostCreate(self, cursor):
+    super()._PostCreate(cursor)
+    self._Invalidate(cursor)
+
+  def _PreSave(self, cursor):
+    super()._PreSave(cursor)
+    self.Sanitize(self)
+    stored = cursor.Select(table=self.TableName(), fields=('gscode',),
+                           conditions='ID = %d' % self.key)
+    self._gscodechanged = not stored or (
+        str(stored[0]['gscode'] or '') != str(self.get('gscode') or ''))
+
+  def _PostSave(self, cursor):
+    super()._PostSave(cursor)
+    if self._gscodechanged:
+      self._UpdateBarcodes(cursor)
+    self._Invalidate(cursor)
+
+  def _Invalidate(self, cursor):
+    """Marks the cached suppliers as stale, in this and other processes."""
+    Tableversion.Bump(cursor, self.TableName())
+    type(self)._cache = None
+
+  def _UpdateBarcodes(self, cursor):
+    """Updates the barcodes of this supplier's products without their own ean,
+    which are derived from the supplier's gscode."""
+    try:
+      prefix = '"%d"' % int(self['gscode'])
+    except (KeyError, TypeError, ValueError):
+      prefix = 'NULL'
+    cursor.Execute("""UPDATE `%s`
+                      SET barcode = CONCAT(%s, LPAD(gs1, GREATEST(3, LENGTH(gs1)), "0"))
+                      WHERE supplier = %d AND
+                            (ean IS NULL OR ean = "") AND
+                            gs1""" % (Product.TableName(), prefix, self.key))
+    Tableversion.Bump(cursor, Product.TableName())
 
   @classmethod
   def List(cls, connection, conditions=[], *args, **kwargs):
@@ -334,7 +1685,7 @@ class Supplier(model.Record):
       *args, **kwargs)
 
   @classmethod
-  def Search(cls, connection, query=None, conditions=None, **kwargs):
+  def Search(cls, connection, query=None, order=None, conditions=None, **kwargs):
     """Returns the articles matching the search
 
       Arguments:
@@ -348,7 +1699,7 @@ class Supplier(model.Record):
     return cls.List(
       connection,
       conditions=['name like "%%%s%%"' % connection.EscapeValues(query)[1:-1]] + conditions,
-      order=[('ID', True)],
+      order=order or [('ID', True)],
       **kwargs)
 
   @classmethod
@@ -368,6 +1719,12 @@ class Supplier(model.Record):
     Returns:
       Supplier: supplier abstraction class.
     """
+    if not conditions:
+      supplier = cls._Cache(connection)['byname'].get(name)
+      if not supplier:
+        raise cls.NotExistError(
+            'There is no supplier with common name %r' % name)
+      return cls(connection, dict(supplier))
     safe_name = connection.EscapeValues(name)
     with connection as cursor:
       supplier = cursor.Select(table=cls.TableName(),
@@ -388,29 +1745,50 @@ class Supplier(model.Record):
     """List products for this supplier"""
     return self.__children__(Products)
 
-  def _PreCreate(self, cursor):
-    super()._PreCreate(cursor)
-    if self['gscode']:
-      self['gscode'] = self['gscode'][:10]
-    if self['name']:
-      self['name'] = re.search('([\w\-_\.,]+)',
-          self['name'].replace(' ', '_')).groups()[0][:45]
-    if not self['name']:
-      raise InvalidNameError('Provide a valid name')
+  @staticmethod
+  def Sanitize(supplier):
+    """Cleans up the fields of a supplier (or a dict) before it is written.
 
-  def _PreSave(self, cursor):
-    super()._PreSave(cursor)
-    if self['gscode']:
-      self['gscode'] = self['gscode'][:10]
-    if self['name']:
-      self['name'] = re.search('([\w\-_\.,]+)',
-          self['name'].replace(' ', '_')).groups()[0][:45]
-    if not self['name']:
+    Raises:
+      InvalidNameError: the supplier has no usable name.
+    """
+    if supplier.get('gscode'):
+      supplier['gscode'] = supplier['gscode'][:10]
+    supplier['name'] = SanitizeName(supplier.get('name'), 45)
+    if not supplier['name']:
       raise InvalidNameError('Provide a valid name')
 
+  def _PreCreate(self, cursor):
+    super()._PreCreate(cursor)
+    self.Sanitize(self)
+
 
 class User(model.Record):
-  """Provides interaction to the user table"""
+  """Provides interaction to the user table
+
+  Active users are cached per process by FromPrimaryCached, so identifying the
+  user of a session does not need a query on every request. Writes to a user
+  drop its cache entry right away, other processes see the change once the
+  entry expires.
+  """
+  CACHE = cache.LRUCache(maxsize=256, ttl=10)
+
+  @classmethod
+  def FromPrimaryCached(cls, connection, pkey_value):
+    """Returns the user with the given ID, from the user cache if possible.
+
+    Raises:
+      NotExistError:
+        The given user does not exist.
+    """
+    userid = int(pkey_value)
+    cached = cls.CACHE.Get(userid)
+    if cached is None:
+      user = cls.FromPrimary(connection, userid)
+      if user['active'] == 'true':
+        cls.CACHE.Set(userid, dict(user))
+      return user
+    return cls(connection, dict(cached))
 
   @classmethod
   def FromEmail(cls, connection, email, conditions=None):
@@ -442,7 +1820,15 @@ class User(model.Record):
 
   @classmethod
   def FromLogin(cls, connection, email, password):
-    """Returns the user with the given login details."""
+    """Returns the user with the given login details.
+
+    Passwords are verified in the hashing processes. A password stored with
+    other pbkdf2 rounds than configured is hashed again, and saved.
+
+    Raises:
+      NotExistError: the login details are not valid.
+      hashing.HasherBusyError: too many logins are being verified already.
+    """
     user = list(cls.List(connection,
         conditions=('email = %s' % connection.EscapeValues(email),
                     'active = "true"')))
@@ -450,19 +1836,38 @@ class User(model.Record):
       # fake a login attempt, and slow down, even though we know its never going
       # to end in a valid login, we dont want to let anyone know the account
       # does or does not exist.
-      if connection.debug:
-        print('password for non existant user would have been: ', pbkdf2_sha256.hash(password))
+      hashing.HASHER.Verify(password, hashing.HASHER.UnknownHash())
       raise cls.NotExistError('Invalid login, or inactive account.')
-    if pbkdf2_sha256.verify(password, user[0]['password']):
-      return user[0]
-    raise cls.NotExistError('Invalid password')
+    valid, newhash = hashing.HASHER.Verify(password, user[0]['password'])
+    if not valid:
+      raise cls.NotExistError('Invalid password')
+    if newhash:
+      user[0]['password'] = newhash
+      user[0].Save()
+    return user[0]
 
-  def UpdatePassword(self, password):
-    """Hashes the password and stores it in the database"""
+  @staticmethod
+  def HashPassword(password):
+    """Returns the hash to store for the password.
+
+    Raises:
+      ValueError: the password is too short.
+      hashing.HasherBusyError: too many passwords are being hashed already.
+    """
     if len(password) < 8:
       raise ValueError('password too short, 8 characters minimal.')
-    self['password'] = pbkdf2_sha256.hash(password)
+    return hashing.HASHER.Hash(password)
+
+  def UpdatePassword(self, password):
+    """Hashes the password and stores it in the database
+
+    Raises:
+      ValueError: the password is too short.
+      hashing.HasherBusyError: too many passwords are being hashed already.
+    """
+    self['password'] = self.HashPassword(password)
     self.Save()
+    self.CACHE.Invalidate(self.key)
 
   def _PreCreate(self, cursor):
     super()._PreCreate(cursor)
@@ -474,9 +1879,18 @@ class User(model.Record):
     self['email'] = self['email'][:255]
     self['active'] = 'true' if self['active'] == 'true' else 'false'
 
+  def _PostSave(self, cursor):
+    super()._PostSave(cursor)
+    self.CACHE.Invalidate(self.key)
+
+  def Delete(self):
+    """Deletes the user, and removes it from the user cache."""
+    super().Delete()
+    self.CACHE.Invalidate(self.key)
+
   def PasswordResetHash(self):
     """Returns a hash based on the user's ID, name and password."""
-    return pbkdf2_sha256.hash('%d%s%s' % (
+    return hashing.HASHER.Hash('%d%s%s' % (
          self['ID'], self['email'], self['password']),
          salt=bytes(self['ID']))
 
@@ -486,9 +1900,17 @@ class Session(model.SecureCookie):
 
 
 class Apiuser(model.Record):
-  """Provides a model abstraction for the apiuser table"""
+  """Provides a model abstraction for the apiuser table
+
+  Keys are cached per process by FromKeyCached. Invalid keys are cached too,
+  for a shorter time, so repeated requests with a bad key do not reach the
+  database either. They are kept in a separate, smaller cache, so a flood of
+  bad keys cannot push the valid keys out.
+  """
 
   KEYLENGTH = 32
+  KEYCACHE = cache.LRUCache(maxsize=1024, ttl=10)
+  INVALIDKEYCACHE = cache.LRUCache(maxsize=256, ttl=5)
 
   def _PreCreate(self, cursor):
     super()._PreCreate(cursor)
@@ -523,6 +1945,41 @@ class Apiuser(model.Record):
       raise cls.NotExistError('Invalid key, or inactive key.')
     return user[0]
 
+  @classmethod
+  def FromKeyCached(cls, connection, key):
+    """Returns a user object by API key, from the key cache if possible."""
+    cached = cls.KEYCACHE.Get(key)
+    if cached is not None:
+      return cls(connection, dict(cached))
+    invalid = cls.INVALIDKEYCACHE.Get(key)
+    if invalid is not None:
+      raise cls.NotExistError(invalid)
+    try:
+      user = cls.FromKey(connection, key)
+    except cls.NotExistError as error:
+      cls.INVALIDKEYCACHE.Set(key, str(error))
+      raise
+    cls.KEYCACHE.Set(key, dict(user))
+    return user
+
+  @classmethod
+  def _Uncache(cls, key):
+    cls.KEYCACHE.Invalidate(key)
+    cls.INVALIDKEYCACHE.Invalidate(key)
+
+  def _PostCreate(self, cursor):
+    super()._PostCreate(cursor)
+    self._Uncache(self['key'])
+
+  def _PostSave(self, cursor):
+    super()._PostSave(cursor)
+    self._Uncache(self['key'])
+
+  def Delete(self):
+    """Deletes the key, and removes it from the key cache."""
+    super().Delete()
+    self._Uncache(self['key'])
+
 
 class InvalidNameError(Exception):
   """Invalid name value."""
@@ -534,4 +1991,7 @@ class AssemblyError(WarehouseException):
   """The requested operation cannot continue because we could not assemble a
   product as requested."""
 
+class AssemblyCycleError(AssemblyError):
+  """The bill of materials of a product contains the product itself."""
+
 NotExistError = model.NotExistError
@@ -2,8 +2,15 @@
 """Request handlers for the uWeb3 warehouse inventory software"""
 
 # standard modules
+import csv
+import hashlib
+import io
+import itertools
+import json
+import math
+import os
+import threading
 import time
-import locale
 import urllib.parse
 
 # uweb modules
@@ -11,8 +18,32 @@ import uweb3
 from uweb3.libs import mail
 
 # project modules
+from . import cache
+from . import hashing
+from . import importer
 from . import model
-from .helpers import PagedResult
+from . import pool
+from . import settings
+from . import templatecache
+from .helpers import SeekPagedResult
+
+# WSGI environ key under which a handler leaves a response body to be streamed.
+STREAMKEY = 'warehouse.stream'
+# WSGI environ key holding the pooled database connections of the request.
+CONNECTIONKEY = 'warehouse.connections'
+# Config section of the read replica, and the cookie that keeps a client on the
+# primary database after it changed something.
+REPLICASECTION = 'mysqlreplica'
+STICKYCOOKIE = 'primary'
+
+# JsonProduct results, shared by concurrent requests for the same product, and
+# reused for productcachems milliseconds while the product's version is the
+# same. Results are stored with the version they were built at.
+PRODUCTFLIGHTS = cache.SingleFlight()
+PRODUCTRESULTS = cache.LRUCache(maxsize=1024, ttl=0)
+model.PRODUCTLISTENERS.append(lambda productids: PRODUCTRESULTS.Discard(
+    lambda cached: cached[1]['product'].key in productids))
+
 
 def apiuser(f):
   """Decorator to check if the given API key is allowed to access the resource."""
@@ -29,13 +60,55 @@ def apiuser(f):
     elif 'apikey' in args[0].req.headers:
       key = args[0].req.headers.get('apikey')
     try:
-      args[0].apikey = model.Apiuser.FromKey(args[0].connection, key)
+      args[0].apikey = model.Apiuser.FromKeyCached(args[0].connection, key)
     except model.Apiuser.NotExistError as apierror:
       return uweb3.Response(content={'error': str(apierror)}, httpcode=403)
     return f(*args, **kwargs)
   return wrapper
 
 
+def readonly(f):
+  """Decorator to serve GET requests from the read replica, if one is set up.
+
+  The handler and everything it calls should only read from self.connection,
+  writes go through self.primary.
+  """
+  def wrapper(*args, **kwargs):
+    args[0].replicaallowed = args[0].req.method == 'GET'
+    return f(*args, **kwargs)
+  return wrapper
+
+
+def conditional(etag):
+  """Decorator to answer a GET request with a 304 Not Modified when the client
+  already has the current version of the response.
+
+  Arguments:
+    @ etag: function
+      Called with the handler's arguments, returns the ETag of the response
+      without building it, or None when the response cannot be tagged.
+  """
+  def decorator(f):
+    def wrapper(*args, **kwargs):
+      if args[0].req.method not in ('GET', 'HEAD'):
+        return f(*args, **kwargs)
+      tag = etag(*args, **kwargs)
+      if tag is None:
+        return f(*args, **kwargs)
+      matches = {match.strip().replace('W/', '', 1) for match in
+                 args[0].req.env.get('HTTP_IF_NONE_MATCH', '').split(',')}
+      if '*' in matches or tag.replace('W/', '', 1) in matches:
+        return uweb3.Response(content='', httpcode=304, headers={'ETag': tag})
+      response = f(*args, **kwargs)
+      if not isinstance(response, uweb3.Response):
+        response = uweb3.Response(content=response)
+      if response.httpcode == 200:
+        response.headers['ETag'] = tag
+      return response
+    return wrapper
+  return decorator
+
+
 def NotExistsErrorCatcher(f):
   """Decorator to return a 404 if a NotExistError exception was returned."""
   def wrapper(*args, **kwargs):
@@ -50,6 +123,155 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
   """Holds all the request handlers for the application"""
 
   DEFAULTPAGESIZE = 10
+  MAXBATCHSIZE = 5000
+  MAXSEARCHLIMIT = 100
+  MAXIMPORTERRORS = 500
+  MAXPRODUCTSPERREQUEST = 250
+  TEMPLATES = None
+  POOLS = {}
+  _POOLLOCK = threading.Lock()
+  replicaallowed = False
+  _requestparser = None
+  _productversions = None
+
+  @classmethod
+  def LoadTemplates(cls):
+    """Compiles all templates into a parser shared by every request.
+
+    This is called when the application is created, before any web workers
+    are forked, so they all share the compiled templates.
+    """
+    cls.TEMPLATES = templatecache.Parser()
+    cls.TEMPLATES.Warm()
+
+  @property
+  def parser(self):
+    """Returns the template parser of this request, which renders with the
+    shared templates, loading those when needed."""
+    if self._requestparser is None:
+      if PageMaker.TEMPLATES is None:
+        PageMaker.LoadTemplates()
+      self._requestparser = templatecache.RequestParser(PageMaker.TEMPLATES)
+    return self._requestparser
+
+  @classmethod
+  def Pool(cls, options, section='mysql'):
+    """Returns the connection pool of this process for the given config
+    section, creating it when needed.
+
+    Every worker process gets its own pools, pools inherited from the process
+    the worker was forked from are not used.
+    """
+    with cls._POOLLOCK:
+      connections = PageMaker.POOLS.get(section)
+      if connections is None or connections.pid != os.getpid():
+        connections = PageMaker.POOLS[section] = pool.FromOptions(
+            options[section], name=section)
+      return connections
+
+  @property
+  def connection(self):
+    """Returns the database connection of this request.
+
+    Handlers marked readonly use the read replica when one is configured,
+    all others use the primary database. The connection is checked out of the
+    pool on first use, and returned to it by the application once the
+    response has been sent.
+    """
+    if self.fromreplica:
+      return self._Connection(REPLICASECTION)
+    return self.primary
+
+  @property
+  def primary(self):
+    """Returns the connection to the primary database, for writes."""
+    return self._Connection('mysql')
+
+  @property
+  def fromreplica(self):
+    """Returns whether this request reads from the read replica.
+
+    That is the case for GET requests to readonly handlers, unless the client
+    changed something less than stickyseconds ago, so it sees its own changes.
+    """
+    if not self.replicaallowed or REPLICASECTION not in self.options:
+      return False
+    try:
+      return float(self.cookies.get(STICKYCOOKIE, 0)) < time.time()
+    except ValueError:
+      return True
+
+  def _Connection(self, section):
+    connections = self.req.env.setdefault(CONNECTIONKEY, {})
+    if section not in connections:
+      connections[section] = self.Pool(self.options, section).Get()
+    return connections[section]
+
+  @staticmethod
+  def ReleaseConnection(env, check=False):
+    """Returns the request's database connections to their pools.
+
+    Arguments:
+      @ env: dict
+        The WSGI environ of the request.
+      % check: bool ~~ False
+        Discard connections that no longer work, after the request failed.
+    """
+    for section, connection in env.pop(CONNECTIONKEY, {}).items():
+      PageMaker.POOLS[section].Put(
+          connection, discard=check and not pool.Ping(connection))
+
+  def _PageETag(self, *versions, weak=False):
+    """Returns the ETag of an HTML page built from data at the given versions.
+
+    The tag also covers the user, their xsrf token, the query string and the
+    templates, which change the page as well.
+    """
+    digest = hashlib.sha1(repr((
+        versions,
+        self.user['ID'] if self.user else None,
+        self._Get_XSRF(),
+        self.req.env.get('QUERY_STRING', ''),
+        sorted(self.parser.mtimes.items()))).encode('utf-8')).hexdigest()
+    return '%s"%s"' % ('W/' if weak else '', digest)
+
+  def _ListETag(self, *args, **kwargs):
+    """Returns the weak ETag of a product or supplier listing."""
+    return self._PageETag(
+        model.Tableversion.Current(self.connection, ('product', 'supplier')),
+        weak=True)
+
+  def _ProductVersion(self, name):
+    """Returns the ID and version of the named product, read once per request,
+    see Productversion.FromName."""
+    if self._productversions is None:
+      self._productversions = {}
+    if name not in self._productversions:
+      self._productversions[name] = model.Productversion.FromName(
+          self.connection, name)
+    return self._productversions[name]
+
+  def _ProductPageETag(self, name):
+    """Returns the ETag of the product page."""
+    return self._PageETag(
+        self._ProductVersion(name),
+        model.Tableversion.Current(self.connection, ('product', 'supplier')))
+
+  def _ProductETag(self, name):
+    """Returns the ETag of the product's JSON, from its version and the
+    version of the suppliers, or None if there is no such product."""
+    try:
+      productid, version = self._ProductVersion(name)
+    except model.NotExistError:
+      return None
+    return '"%d-%s-%d"' % (productid, version, model.Tableversion.Current(
+        self.connection, ('supplier',))['supplier'])
+
+  def _SearchETag(self):
+    """Returns the weak ETag of product search results."""
+    return 'W/"%s"' % hashlib.sha1(repr((
+        model.Tableversion.Current(self.connection, ('product',)),
+        self.req.env.get('QUERY_STRING', ''))).encode('utf-8')).hexdigest()
 
   def _PostInit(self):
     """Sets up all the default vars"""
@@ -60,20 +282,33 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
     self.parser.RegisterFunction('TextareaRowCount', lambda x: len(str(x).split('\n')))
     self.parser.RegisterTag('header', self.parser.JITTag(lambda: self.parser.Parse(
                 'parts/header.html')))
-    self.parser.RegisterTag('footer', self.parser.JITTag(lambda: self.parser.Parse(
-                'parts/footer.html', year=time.strftime('%Y'))))
+    self.parser.RegisterTag('footer', self.parser.Fragment(
+                'parts/footer.html', year=time.strftime('%Y')))
     self.validatexsrf()
     self.parser.RegisterTag('xsrf', self._Get_XSRF())
     self.parser.RegisterTag('user', self.user)
     self.pagesize = int(self.options['general'].get('pagesize', self.DEFAULTPAGESIZE))
 
   def _PreRequest(self):
-    if self.config.Read():
-      try:
-        locale.setlocale( locale.LC_ALL, self.options['general'].get('locale', 'en_GB'))
-        self.parser.RegisterFunction('currency', lambda x: locale.currency(x, symbol=False, grouping=True))
-      except locale.Error:
-        self.parser.RegisterFunction('currency', lambda x: x)
+    self.settings = settings.WATCHER.Current(self._ReadConfig)
+    if self.settings.templatereload:
+      self.parser.Refresh()
+    self.parser.RegisterFunction('currency', self.settings.Currency)
+    hashing.HASHER.Configure(self.settings.options.get('hashing'))
+
+  def _PostRequest(self, response):
+    """Keeps the client on the primary database for stickyseconds after a
+    request that may have changed something, so its next pages show that."""
+    if self.req.method not in ('GET', 'HEAD') and REPLICASECTION in self.options:
+      seconds = int(self.options[REPLICASECTION].get('stickyseconds', 10))
+      self.req.AddCookie(STICKYCOOKIE, str(int(time.time()) + seconds),
+                         max_age=seconds, path='/', httponly=True)
+    return super()._PostRequest(response)
+
+  def _ReadConfig(self):
+    """Reads the config file, and returns its sections."""
+    self.config.Read()
+    return self.options
 
   @uweb3.decorators.TemplateParser('login.html')
   def RequestLogin(self, url=None):
@@ -105,33 +340,52 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
         'password' not in self.post):
       return self.RequestIndex()
     url = self.post.getfirst('url', None) if self.post.getfirst('url', '').startswith('/') else '/'
+    email = self.post.getfirst('email').strip().lower()
+    address = self.req.env.get('REMOTE_ADDR')
+    if not hashing.THROTTLE.Allowed(email, address):
+      self.parser.RegisterTag('loginerror',
+                              'Too many failed logins, try again in a few minutes.')
+      return self.RequestLogin(url)
     try:
       self._user = model.User.FromLogin(self.connection,
           self.post.getfirst('email'), self.post.getfirst('password'))
       model.Session.Create(self.connection, int(self.user), path="/")
+      hashing.THROTTLE.Succeeded(email)
       print('login successful.', self.post.getfirst('email'))
       # redirect 303 to make sure we GET the next page, not post again to avoid leaking login details.
       return self.req.Redirect(url, httpcode=303)
     except model.User.NotExistError as error:
+      hashing.THROTTLE.Failed(email, address)
       self.parser.RegisterTag('loginerror', '%s' % error)
       print('login failed.', self.post.getfirst('email'))
+    except hashing.HasherBusyError as error:
+      self.parser.RegisterTag('loginerror', '%s' % error)
     return self.RequestLogin(url)
 
   @uweb3.decorators.checkxsrf
   def RequestResetPassword(self, email=None, resethash=None):
-    """Handles the post for the reset password."""
+    """Handles the post for the reset password.
+
+    Unknown email addresses are hashed as well, so they take as long as known
+    ones and get the same answer when the hasher is busy.
+    """
     message = None
-    error = False
     if not email and not resethash:
       try:
         user = model.User.FromEmail(self.connection,
                                     self.post.getfirst('email', ''))
       except model.User.NotExistError:
-        error = True
+        user = None
         if self.debug:
           print('Password reset request for unknown user %s:' % self.post.getfirst('email', ''))
-      if not error:
-        resethash = user.PasswordResetHash()
+      try:
+        if user:
+          resethash = user.PasswordResetHash()
+        else:
+          hashing.HASHER.Hash(self.post.getfirst('email', ''))
+      except hashing.HasherBusyError as busy:
+        return self.parser.Parse('reset.html', message=str(busy))
+      if user:
         content = self.parser.Parse('email/resetpass.txt', email=user['email'],
                                     host=self.options['general']['host'],
                                     resethash=resethash)
@@ -146,11 +400,23 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
 
       message = 'If that was an email address that we know, a mail with reset instructions will be in your mailbox soon.'
       return self.parser.Parse('reset.html', message=message)
+    address = self.req.env.get('REMOTE_ADDR')
+    if not hashing.THROTTLE.Allowed(address=address):
+      return self.parser.Parse('reset.html', message='Too many wrong reset codes, try again in a few minutes.')
     try:
       user = model.User.FromEmail(self.connection, email)
     except model.User.NotExistError:
-      return self.parser.Parse('reset.html', message='Sorry, that\'s not the right reset code.')
-    if resethash != user.PasswordResetHash():
+      user = None
+    try:
+      if user:
+        valid = resethash == user.PasswordResetHash()
+      else:
+        hashing.HASHER.Hash(email)
+        valid = False
+    except hashing.HasherBusyError as error:
+      return self.parser.Parse('reset.html', message=str(error))
+    if not valid:
+      hashing.THROTTLE.Failed(address=address)
       return self.parser.Parse('reset.html', message='Sorry, that\'s not the right reset code.')
 
     if 'password' in self.post:
@@ -159,6 +425,8 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
           user.UpdatePassword(self.post.getfirst('password', ''))
         except ValueError:
           return self.parser.Parse('reset.html', message='Password too short, 8 characters minimal.')
+        except hashing.HasherBusyError as error:
+          return self.parser.Parse('reset.html', message=str(error))
         model.Session.Create(self.connection, int(user), path="/")
         self._user = user
         return self.parser.Parse('reset.html', message='Your password has been updated, and you are logged in.')
@@ -175,7 +443,7 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
       user = model.Session(self.connection)
     except Exception:
       raise ValueError('Session cookie invalid')
-    user = model.User.FromPrimary(self.connection, int(str(user)))
+    user = model.User.FromPrimaryCached(self.connection, int(str(user)))
     if user['active'] != 'true':
       raise ValueError('User not active, session invalid')
     return user
@@ -196,17 +464,20 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
         'password_confirm' in self.post and
         'hostname' in self.post and
         self.post.getfirst('password') == self.post.getfirst('password_confirm')):
+      try:
+        password = model.User.HashPassword(self.post.getfirst('password', ''))
+      except ValueError:
+        return {'error': 'Password too short, 8 characters minimal.'}
+      except hashing.HasherBusyError as error:
+        return {'error': str(error)}
       user = model.User.Create(self.connection,
           {'ID': 1,
            'email': self.post.getfirst('email'),
-           'password': '',
+           'password': password,
            'active': 'true'})
-      try:
-        user.UpdatePassword(self.post.getfirst('password', ''))
-      except ValueError:
-        return {'error': 'Password too short, 8 characters minimal.'}
       self.config.Create('general', 'host', self.post.getfirst('hostname'))
       self.config.Create('general', 'locale', self.post.getfirst('locale', 'en_GB'))
+      settings.WATCHER.Expire()
       model.Session.Create(self.connection, int(user), path="/")
       return self.req.Redirect('/', httpcode=301)
     if self.post:
@@ -220,6 +491,17 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
     """Returns the admin page."""
     if self.user['ID'] != 1:
       return self.req.Redirect('/')
+    self.parser.RegisterTag('templatestats', self.parser.Stats())
+    poolstats = []
+    for section in ('mysql', REPLICASECTION):
+      if section in self.options:
+        stats = self.Pool(self.options, section).Stats()
+        stats['averagewait'] = round(
+            stats['waittime'] / stats['waits'] * 1000, 3) if stats['waits'] else 0
+        stats['maxwait'] = round(stats['maxwaittime'] * 1000, 3)
+        poolstats.append(stats)
+    self.parser.RegisterTag('poolstats', poolstats)
+    self.parser.RegisterTag('hashingstats', hashing.HASHER.Stats())
 
     currentusers = list(model.User.List(self.connection))
     if self.post:
@@ -258,6 +540,9 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
             except ValueError:
               return {'usererror': 'Password too short, 8 characters minimal.',
                       'users': currentusers}
+            except hashing.HasherBusyError as error:
+              return {'usererror': str(error),
+                      'users': currentusers}
           user.Save()
           users.append(user)
       else:
@@ -266,17 +551,20 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
     # handle User creation
     if ('useremail' in self.post and
         'new' in values['useremail']):
+      newpassword = values['userpassword'].get('new', '').strip()
+      try:
+        password = model.User.HashPassword(newpassword)
+      except ValueError:
+        return {'usererror': 'Password too short, 8 characters minimal.',
+                'users': users}
+      except hashing.HasherBusyError as error:
+        return {'usererror': str(error),
+                'users': users}
       try:
         newuser = model.User.Create(self.connection,
           {'email': values['useremail'].get('new', '').strip(),
            'active': values['useractive'].get('new', 'true'),
-           'password': ''})
-        try:
-          newpassword = values['userpassword'].get('new', '').strip()
-          newuser.UpdatePassword(newpassword)
-        except ValueError:
-          return {'usererror': 'Password too short, 8 characters minimal.',
-                  'users': users}
+           'password': password})
         users.append(newuser)
       except model.InvalidNameError:
         return {'usererror': 'Provide a valid email address for the new user.',
@@ -315,6 +603,8 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
       except ValueError:
         return {'error': 'Passwords too short.',
                 'keys': keys}
+      except hashing.HasherBusyError as error:
+        return {'error': str(error)}
       else:
         content = self.parser.Parse('email/updateuser.txt', email=self.user['email'])
         try:
@@ -330,6 +620,8 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
   @uweb3.decorators.TemplateParser('apisettings.html')
   def RequestApiSettings(self):
     """Returns the api settings page."""
+    self.parser.RegisterTag('keycache', model.Apiuser.KEYCACHE.Stats())
+    self.parser.RegisterTag('invalidkeycache', model.Apiuser.INVALIDKEYCACHE.Stats())
     currentkeys = list(model.Apiuser.List(self.connection))
 
     # handle api key updates
@@ -368,6 +660,9 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
       except ValueError:
         return {'error': 'Passwords too short.',
                 'keys': keys}
+      except hashing.HasherBusyError as error:
+        return {'error': str(error),
+                'keys': keys}
       else:
         content = self.parser.Parse('email/updateuser.txt', email=self.user['email'])
         try:
@@ -402,7 +697,9 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
     """Returns the homepage"""
     return self.RequestProducts()
 
+  @readonly
   @uweb3.decorators.loggedin
+  @conditional(_ListETag)
   @uweb3.decorators.TemplateParser('products.html')
   def RequestProducts(self):
     """Returns the Products page"""
@@ -418,31 +715,44 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
       except model.User.NotExistError:
         pass
 
-    products_args = {'conditions': conditions,
-                     'order': [('ID', True)]}
+    products_args = {'conditions': conditions}
     query = ''
     if 'query' in self.get and self.get.getfirst('query', False):
       query = self.get.getfirst('query', '')
       linkarguments['query'] = query
-      products_method = model.Product.FromEAN
-      products_args['ean'] = query
-      del(products_args['order'])
+      products_method = model.Product.Search
+      products_args['query'] = query
     else:
       products_method = model.Product.List
+    if 'count' in self.get:
+      linkarguments['count'] = 1
 
-    products = PagedResult(self.pagesize,
-                           self.get.getfirst('page', 1),
-                           products_method,
-                           self.connection,
-                           products_args)
+    if 'count' in self.get:
+      count = True
+    elif not conditions and not query:
+      count = SeekPagedResult.ESTIMATE
+    else:
+      count = False
+    products = SeekPagedResult(self.pagesize,
+                               self.get.getfirst('page', ''),
+                               products_method,
+                               self.connection,
+                               products_args,
+                               order=('ID', True),
+                               count=count,
+                               prefetch=('supplier',),
+                               countcache=model.COUNTCACHE,
+                               counttables=('product',))
     return {
         'supplier': supplier,
         'products': products,
         'linkarguments': urllib.parse.urlencode(linkarguments) or '',
         'query': query,
-        'suppliers': list(model.Supplier.List(self.connection))}
+        'suppliers': model.Supplier.All(self.connection)}
 
+  @readonly
   @uweb3.decorators.loggedin
+  @conditional(_ListETag)
   @uweb3.decorators.TemplateParser('gs1.html')
   def RequestGS1(self):
     """Returns the gs1 page"""
@@ -458,23 +768,30 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
       except model.Product.NotExistError:
         products = []
     else:
-      products = PagedResult(self.pagesize,
-                             self.get.getfirst('page', 1),
-                             model.Product.List,
-                             self.connection,
-                             {'conditions': ['(gs1 is not null)'],
-                                             'order': [('gs1', False)]})
+      if 'count' in self.get:
+        linkarguments['count'] = 1
+      products = SeekPagedResult(self.pagesize,
+                                 self.get.getfirst('page', ''),
+                                 model.Product.List,
+                                 self.connection,
+                                 {'conditions': ['(gs1 is not null)']},
+                                 order=('gs1', False),
+                                 count='count' in self.get,
+                                 countcache=model.COUNTCACHE,
+                                 counttables=('product',))
     return {
         'products': products,
         'linkarguments': urllib.parse.urlencode(linkarguments) or '',
         'query': query}
 
+  @readonly
   @uweb3.decorators.loggedin
+  @conditional(_ListETag)
   @uweb3.decorators.TemplateParser('ean.html')
   def RequestEAN(self):
     """Returns the EAN page"""
     supplier = None
-    conditions = ['(gs1 is not null or ean is not null)']
+    conditions = ['barcode is not null']
     linkarguments = {}
     if 'supplier' in self.get:
       try:
@@ -485,28 +802,35 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
       except model.User.NotExistError:
         pass
 
-    products_args = {'conditions': conditions,
-                     'order': [('ean', False)]}
+    products_args = {'conditions': conditions}
     query = ''
     if 'query' in self.get and self.get.getfirst('query', False):
       query = self.get.getfirst('query', '')
       linkarguments['query'] = query
       products_method = model.Product.EANSearch
       products_args['ean'] = query
+      products_args['prefix'] = True
     else:
       products_method = model.Product.List
+    if 'count' in self.get:
+      linkarguments['count'] = 1
 
-    products = PagedResult(self.pagesize,
-                           self.get.getfirst('page', 1),
-                           products_method,
-                           self.connection,
-                           products_args)
+    products = SeekPagedResult(self.pagesize,
+                               self.get.getfirst('page', ''),
+                               products_method,
+                               self.connection,
+                               products_args,
+                               order=('barcode', False),
+                               count='count' in self.get,
+                               prefetch=('supplier',),
+                               countcache=model.COUNTCACHE,
+                               counttables=('product',))
     return {
         'supplier': supplier,
         'products': products,
         'linkarguments': urllib.parse.urlencode(linkarguments) or '',
         'query': query,
-        'suppliers': list(model.Supplier.List(self.connection))}
+        'suppliers': model.Supplier.All(self.connection)}
 
   @uweb3.decorators.loggedin
   @NotExistsErrorCatcher
@@ -519,52 +843,247 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
     product.Save()
     return self.RequestProducts()
 
+  @readonly
   @uweb3.decorators.loggedin
   @NotExistsErrorCatcher
+  @conditional(_ProductPageETag)
   @uweb3.decorators.TemplateParser('product.html')
   def RequestProduct(self, name):
     """Returns the product page"""
     product = model.Product.FromName(self.connection, name)
+    try:
+      product.possiblestock
+    except model.AssemblyCycleError as error:
+      return self.Error(error)
     parts = product.parts
     if 'unlimitedstock' in self.get:
       stock = list(product.Stock(order=[('dateCreated', True)]))
-      stockrows = False
+      stockpages = None
     else:
-      stock = list(product.Stock(limit=int(self.pagesize),
-                                 order=[('dateCreated', True)],
-                                 yield_unlimited_total_first=True))
-      stockrows = stock[0]
-      stock = stock[1:]
+      stock = stockpages = SeekPagedResult(self.pagesize,
+                                           self.get.getfirst('page', ''),
+                                           product.Stock,
+                                           order=('dateCreated', True))
 
+    usedin = product.products
+    costs = model.Productcost.ForProducts(
+        self.connection,
+        [product.key] + [int(part['part']) for part in parts],
+        store=not self.fromreplica)
     partsprice = {'partstotal':0,
                   'assembly':0,
                   'partcount':0,
-                  'assembledtotal':0}
-    for part in list(parts):
+                  'assembledtotal':costs[product.key]['total']}
+    for part in parts:
+      part['unitcost'] = costs[int(part['part'])]['total']
       partsprice['partcount'] += part['amount']
       partsprice['assembly'] += part['assemblycosts']
       partsprice['partstotal'] += part.subtotal
-      partsprice['assembledtotal'] += part.subtotal + part['assemblycosts']
+    for part in usedin:
+      part['unitcost'] = costs[product.key]['total']
 
-    return {'products': product.AssemblyOptions(),
-            'parts': parts,
+    return {'parts': parts,
             'partsprice': partsprice,
+            'costs': costs[product.key],
             'product': product,
-            'suppliers': model.Supplier.List(self.connection),
+            'suppliers': model.Supplier.All(self.connection),
             'stock': stock,
-            'stockrows': stockrows}
+            'stockpages': stockpages}
 
-  @uweb3.decorators.ContentType('application/json')
+  @readonly
   @apiuser
+  @conditional(_ProductETag)
+  @uweb3.decorators.ContentType('application/json')
   def JsonProduct(self, name):
-    """Returns the product Json"""
+    """Returns the product Json
+
+    Concurrent requests for the same product within a worker, handled by its
+    threads, share a single lookup. With productcachems set in the [general]
+    config, the result is reused for that many milliseconds, while the version
+    of the product and its parts stays the same.
+    """
+    try:
+      _productid, version = self._ProductVersion(name)
+    except model.NotExistError as error:
+      return self.RequestInvalidJsoncommand(str(error))
+    key = (name, self.fromreplica)
+    cached = PRODUCTRESULTS.Get(key)
+    if cached is not None and cached[0] == version:
+      return cached[1]
+    try:
+      return PRODUCTFLIGHTS.Do((key, version),
+                               lambda: self._ProductResult(key, version))
+    except model.NotExistError as error:
+      return self.RequestInvalidJsoncommand(str(error))
+
+  def _ProductResult(self, key, version):
+    """Looks up the product for JsonProduct, and caches the result with the
+    version it was read at.
+
+    The result is only cached when the product's version did not change while
+    it was looked up, so a lookup that started before a stock change does not
+    cache the old stock after the change dropped the cached result.
+    """
+    product = model.Product.FromName(self.connection, key[0])
+    # Loads the supplier now, so the shared result needs no database access
+    # when other requests send it.
+    product['supplier']
+    result = {'product': product,
+              'currentstock': product.currentstock,
+              'possiblestock': product.possiblestock['available'],
+              'costs': model.Productcost.ForProducts(
+                  self.connection, (product.key,),
+                  store=not self.fromreplica).get(product.key)}
+    ttl = int(self.options['general'].get('productcachems', 0))
+    if ttl > 0 and model.Productversion.FromName(
+        self.connection, key[0])[1] == version:
+      PRODUCTRESULTS.Set(key, (version, result), ttl / 1000)
+    return result
+
+  @readonly
+  @apiuser
+  def RequestStockExport(self):
+    """Streams the stock ledger as CSV, or as JSON Lines with ?format=jsonl.
+
+    The export can be filtered on product and supplier (by name), on a date
+    range with start and end (YYYY-MM-DD, end exclusive) and on lot.
+    """
+    # The rows are read while the body is sent, after this handler returned,
+    # from the request's connection which stays checked out until then.
+    connection = self.connection
+    filters = {'start': self.get.getfirst('start') or None,
+               'end': self.get.getfirst('end') or None,
+               'lot': self.get.getfirst('lot') or None}
     try:
-     product = model.Product.FromName(self.connection, name)
+      if self.get.getfirst('product'):
+        filters['product'] = model.Product.FromName(
+            connection, self.get.getfirst('product')).key
+      if self.get.getfirst('supplier'):
+        filters['supplier'] = model.Supplier.FromName(
+            connection, self.get.getfirst('supplier')).key
+      rows = model.Stock.Export(connection, **filters)
+      # Starts the export, so invalid dates are reported before streaming.
+      firstrow = next(rows, None)
     except model.NotExistError as error:
-      return sef.RequestInvalidJsoncommand(error)
-    return {'product': product,
-            'currentstock': product.currentstock,
-            'possiblestock': product.possiblestock['available']}
+      return self.RequestInvalidJsoncommand(str(error))
+    except ValueError:
+      return self.RequestInvalidJsoncommand(
+          'start and end should be dates formatted as YYYY-MM-DD', 400)
+    rows = itertools.chain([firstrow] if firstrow else [], rows)
+    if self.get.getfirst('format') == 'jsonl':
+      return self.Stream((json.dumps(row, default=str) + '\n' for row in rows),
+                         'application/x-ndjson', 'stock.jsonl')
+    return self.Stream(self._CsvLines(model.Stock.EXPORTFIELDS, rows),
+                       'text/csv', 'stock.csv')
+
+  @staticmethod
+  def _CsvLines(fields, rows):
+    """Yields the CSV header line and a line for each row."""
+    line = io.StringIO()
+    writer = csv.DictWriter(line, fields)
+    writer.writeheader()
+    yield line.getvalue()
+    for row in rows:
+      line.seek(0)
+      line.truncate()
+      writer.writerow(row)
+      yield line.getvalue()
+
+  def Stream(self, body, content_type, filename=None):
+    """Returns a response whose body is sent while it is being generated.
+
+    The body is generated after the handler returned. It may keep using the
+    request's database connection, which is only returned to the pool when the
+    body has been sent or the server closed it; it should not use anything
+    else of the PageMaker.
+
+    Arguments:
+      @ body: iterable
+        Yields the response body in str parts.
+      @ content_type: str
+        The content type of the response.
+      % filename: str
+        Offers the response as a download with this name.
+    """
+    self.req.env[STREAMKEY] = (part.encode('utf-8') for part in body)
+    headers = {}
+    if filename:
+      headers['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return uweb3.Response(content='', content_type=content_type,
+                          headers=headers)
+
+  @readonly
+  @uweb3.decorators.ContentType('application/json')
+  @apiuser
+  def JsonProducts(self):
+    """Returns many products with their current and possible stock.
+
+    Products are requested by name, ean (barcode) and ID, given as repeated
+    or comma separated names, eans and ids arguments.
+    """
+    requested = {}
+    for argument in ('names', 'eans', 'ids'):
+      requested[argument] = {value.strip()
+                             for values in self.get.getlist(argument)
+                             for value in values.split(',') if value.strip()}
+    if sum(map(len, requested.values())) > self.MAXPRODUCTSPERREQUEST:
+      return self.RequestInvalidJsoncommand(
+          'No more than %d products per request.' % self.MAXPRODUCTSPERREQUEST, 400)
+    if not all(key.isdigit() for key in requested['ids']):
+      return self.RequestInvalidJsoncommand('ids should be numbers', 400)
+    products = model.Product.Lookup(self.connection,
+                                    names=requested['names'],
+                                    barcodes=requested['eans'],
+                                    ids=requested['ids'])
+    availability = model.Product.Availability(self.connection, products)
+    costs = model.Productcost.ForProducts(self.connection, products,
+                                          store=not self.fromreplica)
+    result = []
+    for product in products:
+      possiblestock = availability[product.key]['possiblestock']
+      result.append({'product': product,
+                     'currentstock': availability[product.key]['currentstock'],
+                     'possiblestock': None if possiblestock == math.inf else possiblestock,
+                     'costs': costs.get(product.key)})
+      requested['names'].discard(product['name'])
+      requested['eans'].discard(product['barcode'])
+      requested['ids'].discard(str(product.key))
+    return {'products': result,
+            'missing': {argument: sorted(values)
+                        for argument, values in requested.items() if values}}
+
+  @readonly
+  @uweb3.decorators.ContentType('application/json')
+  @apiuser
+  def JsonPartOptions(self, name):
+    """Returns the products that can be added as a part of the product."""
+    try:
+      product = model.Product.FromName(self.connection, name)
+      limit = min(int(self.get.getfirst('limit', self.DEFAULTPAGESIZE)),
+                  self.MAXSEARCHLIMIT)
+    except model.NotExistError as error:
+      return self.RequestInvalidJsoncommand(str(error))
+    except ValueError:
+      return self.RequestInvalidJsoncommand('limit should be a number', 400)
+    return {'products': [
+        {'name': part['name'], 'assemblycosts': part['assemblycosts']}
+        for part in product.PartOptions(self.get.getfirst('query', ''),
+                                        limit=max(limit, 1))]}
+
+  @readonly
+  @apiuser
+  @conditional(_SearchETag)
+  @uweb3.decorators.ContentType('application/json')
+  def JsonProductSearch(self):
+    """Returns the best matching products for the query, best match first."""
+    try:
+      limit = min(int(self.get.getfirst('limit', self.DEFAULTPAGESIZE)),
+                  self.MAXSEARCHLIMIT)
+    except ValueError:
+      return self.RequestInvalidJsoncommand('limit should be a number', 400)
+    return {'products': list(model.Product.Search(
+        self.connection, query=self.get.getfirst('query', ''),
+        limit=max(limit, 1)))}
 
   @uweb3.decorators.loggedin
   @uweb3.decorators.checkxsrf
@@ -593,6 +1112,28 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
       return self.Error('That name was already taken, go back, try again!', 200)
     return self.req.Redirect('/product/%s' % product['name'], httpcode=301)
 
+  @uweb3.decorators.loggedin
+  @uweb3.decorators.checkxsrf
+  @uweb3.decorators.TemplateParser('import.html')
+  def RequestImport(self):
+    """Imports suppliers, products and parts from an uploaded file."""
+    if not self.post:
+      return {'report': None, 'formats': importer.FORMATS}
+    content = self.post.getfirst('file', '')
+    try:
+      if isinstance(content, bytes):
+        content = content.decode('utf-8-sig')
+      report = importer.Importer(
+          self.connection, dryrun='dryrun' in self.post).Import(
+              importer.Rows(io.StringIO(content, newline=''),
+                            self.post.getfirst('format', 'csv')))
+    except ValueError as error:
+      return self.Error('The file could not be read: %s' % error, 200)
+    return {'report': report,
+            'errors': report['errors'][:self.MAXIMPORTERRORS],
+            'moreerrors': max(len(report['errors']) - self.MAXIMPORTERRORS, 0),
+            'formats': importer.FORMATS}
+
   @uweb3.decorators.loggedin
   @NotExistsErrorCatcher
   @uweb3.decorators.checkxsrf
@@ -601,6 +1142,10 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
     product = model.Product.FromName(self.connection, name)
     try:
       part = model.Product.FromName(self.connection, self.post.getfirst('part'))
+      if (part.key == product.key or
+          product.key in part.bom.Descendants(part.key)):
+        return self.Error('%s contains %s, it cannot be used as its part!' % (
+            part['name'], product['name']), 200)
       assembly = model.Productpart.Create(self.connection,
           {'product': product,
            'part': part,
@@ -679,47 +1224,65 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
 
     Send negative amount to Sell a product, positive amount to put product back
     into stock"""
-    try:
-      product = model.Product.FromName(self.connection, name)
-    except model.NotExistError as error:
-      return sef.RequestInvalidJsoncommand(error)
-    amount = int(self.post.getfirst('amount', -1))
-    currentstock = product.currentstock
-    if (amount < 0 and # only assemble when we sell
-        abs(amount) > currentstock): # only assemble when we have not enough stock
-      try:
-        product.Assemble(abs(amount) - currentstock, # only assemble what is missing for this sale
-                         'Assembly for %s' % self.post.getfirst('reference') if 'reference' in self.post else None)
-      except model.AssemblyError as error:
-        return self.RequestInvalidJsoncommand(error)
-    # by now we should have enough products in stock, one way or another
-    model.Stock.Create(self.connection,
-          {'product': product,
-           'amount': amount,
-           'reference': self.post.getfirst('reference', '')})
+    result = model.Stock.Batch(self.connection,
+        [{'product': name,
+          'amount': self.post.getfirst('amount', -1),
+          'reference': self.post.getfirst('reference', '')}])[0]
+    if 'error' in result:
+      return self.RequestInvalidJsoncommand(result['error'])
     return True
 
+  @uweb3.decorators.ContentType('application/json')
+  @apiuser
+  def JsonStockBatch(self):
+    """Processes many stock changes in one call, assembling where needed
+
+    Expects a `lines` field holding a JSON list of objects with a `product`
+    name, an `amount` (negative to sell) and optional `reference` and `lot`.
+    Returns the result for each line in the same order."""
+    try:
+      lines = json.loads(self.post.getfirst('lines', ''))
+      if (not isinstance(lines, list) or
+          not all(isinstance(line, dict) for line in lines)):
+        raise ValueError
+    except ValueError:
+      return self.RequestInvalidJsoncommand(
+          'Provide the stock changes as a JSON list of objects in `lines`.', 400)
+    if len(lines) > self.MAXBATCHSIZE:
+      return self.RequestInvalidJsoncommand(
+          'No more than %d stock changes per batch.' % self.MAXBATCHSIZE, 400)
+    return {'results': model.Stock.Batch(self.connection, lines)}
+
+  @readonly
   @uweb3.decorators.loggedin
+  @conditional(_ListETag)
   @uweb3.decorators.TemplateParser('suppliers.html')
   def RequestSuppliers(self, error=None, success=None):
     """Returns the suppliers page"""
     suppliers = None
     query = ''
+    linkarguments = {}
     if 'query' in self.get and self.get.getfirst('query', False):
+      query = self.get.getfirst('query', '')
+      linkarguments['query'] = query
       suppliermethod = model.Supplier.Search
-      supplierarguments = {'query':  self.get.getfirst('query', ''),
-                           'order': [('ID', True)]}
+      supplierarguments = {'query': query}
     else:
       suppliermethod = model.Supplier.List
-      supplierarguments = {'order': [('ID', True)]}
+      supplierarguments = {}
 
-    suppliers = PagedResult(self.pagesize,
-                           self.get.getfirst('page', 1),
-                           suppliermethod,
-                           self.connection,
-                           supplierarguments)
+    suppliers = SeekPagedResult(self.pagesize,
+                                self.get.getfirst('page', ''),
+                                suppliermethod,
+                                self.connection,
+                                supplierarguments,
+                                order=('ID', True),
+                                count=True,
+                                countcache=model.COUNTCACHE,
+                                counttables=('supplier',))
     return {
         'suppliers': suppliers,
+        'linkarguments': urllib.parse.urlencode(linkarguments) or '',
         'query': query,
         'error': error,
         'success': success}
@@ -736,6 +1299,7 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
     supplier.Save()
     return self.RequestSuppliers(success='Changes saved.')
 
+  @readonly
   @uweb3.decorators.loggedin
   @NotExistsErrorCatcher
   @uweb3.decorators.TemplateParser('supplier.html')
@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+"""Database connection pooling for the uWeb3 warehouse inventory software"""
+
+# standard modules
+import collections
+import contextlib
+import os
+import threading
+import time
+
+
+class PoolExhaustedError(Exception):
+  """No connection became available within the checkout timeout."""
+
+
+def Connect(options, source='mysql'):
+  """Returns a new database connection for the [mysql] config options.
+
+  The connection's source attribute holds the name of the config section, so
+  caches can tell reads from a replica apart from reads from the primary.
+  """
+  from uweb3.libs.sqltalk import mysql # pylint: disable=import-outside-toplevel
+  connection = mysql.Connect(host=options.get('host', 'localhost'),
+                             user=options.get('user'),
+                             passwd=options.get('password'),
+                             db=options.get('database'),
+                             charset=options.get('charset', 'utf8'))
+  connection.source = source
+  return connection
+
+
+def Ping(connection):
+  """Returns whether the connection still works."""
+  try:
+    with connection as cursor:
+      cursor.Execute('SELECT 1')
+    return True
+  except Exception: # The driver's errors differ per failure, any means dead.
+    return False
+
+
+def Close(connection):
+  """Closes the connection, ignoring connections that are already broken."""
+  try:
+    connection.close()
+  except Exception:
+    pass
+
+
+class ConnectionPool:
+  """A bounded pool of database connections for a single process.
+
+  Connections are checked for liveness when they have been idle for longer
+  than CHECKINTERVAL seconds, and replaced by a new connection when the check
+  fails. When all connections are in use, a checkout waits until one is
+  returned, for at most the given timeout.
+  """
+  CHECKINTERVAL = 30
+
+  def __init__(self, factory, minsize=1, maxsize=10, timeout=10, name='mysql'):
+    """Sets up the pool, and opens its first minsize connections.
+
+    Arguments:
+      @ factory: callable
+        Returns a new database connection.
+      % minsize: int ~~ 1
+        Number of connections to keep open, even when idle.
+      % maxsize: int ~~ 10
+        Number of connections to open at most.
+      % timeout: float ~~ 10
+        Seconds a checkout waits for a connection before giving up.
+      % name: str ~~ 'mysql'
+        Name of the pool, shown in its statistics.
+    """
+    self.factory = factory
+    self.minsize = minsize
+    self.maxsize = max(maxsize, minsize, 1)
+    self.timeout = timeout
+    self.name = name
+    self.pid = os.getpid()
+    self._idle = collections.deque()
+    self._size = 0
+    self._condition = threading.Condition()
+    self.stats = {'checkouts': 0,
+                  'waits': 0,
+                  'waittime': 0.0,
+                  'maxwaittime': 0.0,
+                  'timeouts': 0,
+                  'created': 0,
+                  'reconnects': 0,
+                  'discarded': 0}
+    for _count in range(minsize):
+      self._idle.append((self._Create(), time.monotonic()))
+
+  def _Create(self):
+    connection = self.factory()
+    with self._condition:
+      self._size += 1
+      self.stats['created'] += 1
+    return connection
+
+  def Get(self, timeout=None):
+    """Checks out a working connection.
+
+    Raises:
+      PoolExhaustedError: no connection was returned within the timeout.
+    """
+    timeout = self.timeout if timeout is None else timeout
+    start = time.monotonic()
+    with self._condition:
+      self.stats['checkouts'] += 1
+      if not self._idle and self._size >= self.maxsize:
+        self.stats['waits'] += 1
+        if not self._condition.wait_for(
+            lambda: self._idle or self._size < self.maxsize, timeout):
+          self.stats['timeouts'] += 1
+          raise PoolExhaustedError(
+              'No %s connection became available within %s seconds' % (
+                  self.name, timeout))
+        waittime = time.monotonic() - start
+        self.stats['waittime'] += waittime
+        self.stats['maxwaittime'] = max(self.stats['maxwaittime'], waittime)
+      if self._idle:
+        connection, returned = self._idle.pop()
+      else:
+        # Reserves the place of the new connection while it is being opened.
+        self._size += 1
+        connection = None
+    if connection is None:
+      try:
+        connection = self.factory()
+      except Exception:
+        self._Release()
+        raise
+      with self._condition:
+        self.stats['created'] += 1
+    elif time.monotonic() - returned > self.CHECKINTERVAL and not Ping(connection):
+      Close(connection)
+      try:
+        connection = self.factory()
+      except Exception:
+        self._Release()
+        raise
+      with self._condition:
+        self.stats['reconnects'] += 1
+    return connection
+
+  def Put(self, connection, discard=False):
+    """Returns a checked out connection to the pool.
+
+    Arguments:
+      @ connection: sqltalk.connection
+        The connection, as returned by Get.
+      % discard: bool ~~ False
+        Close the connection instead of reusing it, after an error.
+
+    A transaction left open on the connection is rolled back first, connections
+    that fail to roll back are discarded.
+    """
+    if not discard:
+      try:
+        connection.rollback()
+      except Exception: # Any driver error means the connection is unusable.
+        discard = True
+    if discard:
+      Close(connection)
+      with self._condition:
+        self.stats['discarded'] += 1
+      self._Release()
+      return
+    with self._condition:
+      self._idle.append((connection, time.monotonic()))
+      self._condition.notify()
+
+  def _Release(self):
+    with self._condition:
+      self._size -= 1
+      self._condition.notify()
+
+  @contextlib.contextmanager
+  def Connection(self):
+    """Checks out a connection for the duration of the with block."""
+    connection = self.Get()
+    try:
+      yield connection
+    except Exception:
+      self.Put(connection, discard=not Ping(connection))
+      raise
+    else:
+      self.Put(connection)
+
+  def Stats(self):
+    """Returns the usage statistics and the current size of the pool."""
+    with self._condition:
+      return dict(self.stats,
+                  name=self.name,
+                  size=self._size,
+                  idle=len(self._idle),
+                  inuse=self._size - len(self._idle),
+                  minsize=self.minsize,
+                  maxsize=self.maxsize)
+
+  def Close(self):
+    """Closes the idle connections, and shrinks the pool accordingly."""
+    with self._condition:
+      idle = [connection for connection, _returned in self._idle]
+      self._idle.clear()
+      self._size -= len(idle)
+    for connection in idle:
+      Close(connection)
+
+
+def FromOptions(options, name='mysql'):
+  """Returns a pool of connections for the given [mysql] config options,
+  sized by their poolminsize, poolmaxsize and pooltimeout options."""
+  return ConnectionPool(lambda: Connect(options, name),
+                        minsize=int(options.get('poolminsize', 1)),
+                        maxsize=int(options.get('poolmaxsize', 10)),
+                        timeout=float(options.get('pooltimeout', 10)),
+                        name=name)
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+"""Production server for the uWeb3 warehouse inventory software
+
+Runs the application under gunicorn with two workers per core plus one. The
+application is created once in the master process, so its code and compiled
+templates are shared copy-on-write by all workers.
+"""
+
+# standard modules
+import argparse
+import multiprocessing
+import sys
+
+# project modules
+from . import main as application
+
+
+def DefaultWorkers():
+  """Returns the number of workers to start, two per core plus one."""
+  return multiprocessing.cpu_count() * 2 + 1
+
+
+def Options(arguments):
+  """Returns the gunicorn settings for the parsed commandline arguments."""
+  options = {'bind': arguments.bind,
+             'workers': arguments.workers,
+             'threads': arguments.threads,
+             'preload_app': not arguments.no_preload,
+             'timeout': arguments.timeout,
+             'graceful_timeout': arguments.timeout,
+             'max_requests': arguments.max_requests,
+             'max_requests_jitter': arguments.max_requests // 10,
+             'pidfile': arguments.pidfile}
+  if arguments.threads > 1:
+    options['worker_class'] = 'gthread'
+  return options
+
+
+def main(argv=None):
+  """Parses the commandline and runs the application under gunicorn."""
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--bind', default=':8001',
+                      help='address to listen on, host:port or unix:path')
+  parser.add_argument('--workers', type=int, default=DefaultWorkers(),
+                      help='number of worker processes (default: %(default)s)')
+  parser.add_argument('--threads', type=int, default=1,
+                      help='threads per worker, more than one uses the '
+                           'threaded gthread worker (default: %(default)s)')
+  parser.add_argument('--timeout', type=int, default=30,
+                      help='seconds a request may take, and a worker may take '
+                           'to finish its requests on a reload')
+  parser.add_argument('--max-requests', type=int, default=1000,
+                      help='restart each worker after about this many requests, '
+                           '0 to keep them running')
+  parser.add_argument('--pidfile', default=None,
+                      help='file to write the master process ID to, for reloads')
+  parser.add_argument('--no-preload', action='store_true',
+                      help='create the application in every worker, which lets '
+                           'a HUP signal load new code')
+  arguments = parser.parse_args(argv)
+  try:
+    from gunicorn.app.base import BaseApplication
+  except ImportError:
+    print('The production server needs gunicorn, install it with: '
+          'pip install gunicorn')
+    return 1
+
+  class Server(BaseApplication):
+    """Runs the application with settings given in code instead of files."""
+
+    def load_config(self):
+      for name, value in Options(arguments).items():
+        self.cfg.set(name, value)
+
+    def load(self):
+      return application()
+
+  Server().run()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
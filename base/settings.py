@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+"""Configuration snapshots for the uWeb3 warehouse inventory software"""
+
+# standard modules
+import decimal
+import os
+import threading
+import time
+import types
+
+CONFIGFILE = os.path.join(os.path.dirname(__file__), 'config.ini')
+
+# Decimal point and thousands separator for amounts, by locale or language.
+SEPARATORS = {
+    'en': ('.', ','),
+    'de_CH': ('.', '\''),
+    'de': (',', '.'),
+    'es': (',', '.'),
+    'it': (',', '.'),
+    'nl': (',', '.'),
+    'pt': (',', '.'),
+    'da': (',', '.'),
+    'fr': (',', ' '),
+    'fi': (',', '\xa0'),
+    'nb': (',', '\xa0'),
+    'pl': (',', '\xa0'),
+    'sv': (',', '\xa0')}
+
+
+def Separators(localename):
+  """Returns the decimal point and thousands separator for the given locale
+  name, such as nl_NL or en_GB.UTF-8, without changing the process locale."""
+  localename = localename.split('.')[0]
+  return SEPARATORS.get(localename,
+                        SEPARATORS.get(localename.split('_')[0], SEPARATORS['en']))
+
+
+class Settings:
+  """An immutable snapshot of the application's configuration.
+
+  A new snapshot is made whenever the config file changes, so a request can
+  use the snapshot it started with while other threads replace it.
+  """
+  __slots__ = ('options', 'mtime', 'locale', 'templatereload', '_separators')
+
+  def __init__(self, options, mtime=None):
+    """Makes a snapshot of the given config options.
+
+    Arguments:
+      @ options: dict
+        The config sections, each a dict of options.
+      % mtime: float ~~ None
+        Modification time of the config file the options were read from.
+    """
+    assign = super().__setattr__
+    assign('options', types.MappingProxyType({
+        section: types.MappingProxyType(dict(values))
+        for section, values in options.items()}))
+    assign('mtime', mtime)
+    general = self.options.get('general', {})
+    assign('locale', general.get('locale', 'en_GB'))
+    assign('templatereload', general.get('templatereload') == 'true')
+    decimalpoint, thousandsseparator = Separators(self.locale)
+    assign('_separators', str.maketrans({'.': decimalpoint,
+                                          ',': thousandsseparator}))
+
+  def __setattr__(self, name, value):
+    raise AttributeError('Settings are read-only')
+
+  def Currency(self, value):
+    """Formats value as an amount with two decimals, grouped by thousands.
+
+    Values that are not numbers, such as None, are returned unchanged.
+    """
+    try:
+      amount = '{:,.2f}'.format(decimal.Decimal(value))
+    except (TypeError, ValueError, decimal.InvalidOperation):
+      return value
+    return amount.translate(self._separators)
+
+
+class ConfigWatcher:
+  """Keeps the settings snapshot of the current config file.
+
+  The file's modification time is checked at most once every CHECKINTERVAL
+  seconds; the config is only read again when it changed.
+  """
+  CHECKINTERVAL = 5
+
+  def __init__(self, path=CONFIGFILE):
+    self.path = path
+    self.checked = 0
+    self.settings = None
+    self._lock = threading.Lock()
+
+  def Current(self, reader):
+    """Returns the current settings.
+
+    Arguments:
+      @ reader: callable
+        Reads the config file, and returns its sections as a dict of dicts.
+    """
+    settings = self.settings
+    if (settings is not None and
+        time.monotonic() - self.checked < self.CHECKINTERVAL):
+      return settings
+    with self._lock:
+      if (self.settings is None or
+          time.monotonic() - self.checked >= self.CHECKINTERVAL):
+        try:
+          mtime = os.stat(self.path).st_mtime
+        except OSError:
+          mtime = None
+        if self.settings is None or mtime != self.settings.mtime:
+          self.settings = Settings(reader(), mtime)
+        self.checked = time.monotonic()
+      return self.settings
+
+  def Expire(self):
+    """Makes the next call to Current check the config file."""
+    self.checked = 0
+
+
+WATCHER = ConfigWatcher()
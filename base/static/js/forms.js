@@ -1,8 +1,34 @@
 
 window.addEventListener('load', (event) => {
   attachpasswordreset();
+  attachpartoptions();
 });
 
+function attachpartoptions(){
+  let inputs = document.querySelectorAll('input[data-options]');
+  inputs.forEach(input => {
+    let options = document.getElementById(input.getAttribute('list'));
+    let timer;
+    input.addEventListener('input', (event) => {
+      clearTimeout(timer);
+      timer = setTimeout(() => {
+        if(input.value.trim() == ''){
+          return;
+        }
+        fetch(input.dataset.options + '?query=' + encodeURIComponent(input.value))
+          .then(response => response.json())
+          .then(result => {
+            options.replaceChildren(...(result.products || []).map(product => {
+              let option = document.createElement('option');
+              option.value = product.name;
+              return option;
+            }));
+          });
+      }, 200);
+    });
+  });
+}
+
 var password;
 var passwordconfirm;
 function attachpasswordreset(){
@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+"""Process-shared template cache for the uWeb3 warehouse inventory software"""
+
+# standard modules
+import os
+import threading
+import time
+
+# uweb modules
+from uweb3 import templateparser
+
+TEMPLATEDIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+
+class Parser(templateparser.Parser):
+  """A template parser that compiles all its templates up front.
+
+  The parser is created once, when the application is created, so workers
+  forked from that process share the compiled templates. Templates that do
+  not depend on the request can be rendered once with Fragment. The time
+  spent rendering is recorded per template.
+
+  Tags for a single request are not registered here, but on that request's
+  RequestParser.
+  """
+  REFRESHINTERVAL = 1
+
+  def __init__(self, path=TEMPLATEDIR, *args, **kwargs):
+    super().__init__(path, *args, **kwargs)
+    self.path = path
+    self.mtimes = {}
+    self.fragments = {}
+    self.timings = {}
+    self.refreshed = 0
+    self._lock = threading.Lock()
+
+  def Warm(self):
+    """Compiles every template below the template directory."""
+    for directory, _directories, filenames in os.walk(self.path):
+      for filename in filenames:
+        self.Load(os.path.relpath(os.path.join(directory, filename), self.path))
+
+  def Load(self, name):
+    """Compiles the named template, and notes its modification time."""
+    self.mtimes[name] = os.path.getmtime(os.path.join(self.path, name))
+    self.AddTemplate(name)
+
+  def Refresh(self):
+    """Recompiles templates whose file changed, for use during development.
+
+    Files are checked at most once every REFRESHINTERVAL seconds, and the
+    rendered fragments are dropped when any template changed.
+    """
+    now = time.time()
+    if now - self.refreshed < self.REFRESHINTERVAL:
+      return
+    self.refreshed = now
+    with self._lock:
+      for name, mtime in list(self.mtimes.items()):
+        if os.path.getmtime(os.path.join(self.path, name)) != mtime:
+          self.Load(name)
+          self.fragments.clear()
+
+  def Fragment(self, name, **replacements):
+    """Returns the template rendered with the given replacements, rendering it
+    only the first time. Only use this for templates that use no other tags
+    than the given replacements."""
+    key = (name, tuple(sorted(replacements.items())))
+    if key not in self.fragments:
+      self.fragments[key] = self.Parse(name, **replacements)
+    return self.fragments[key]
+
+  def Parse(self, template, **replacements):
+    """Renders the template, and records the time that took."""
+    start = time.perf_counter()
+    try:
+      return super().Parse(template, **replacements)
+    finally:
+      duration = time.perf_counter() - start
+      with self._lock:
+        count, total = self.timings.get(template, (0, 0))
+        self.timings[template] = (count + 1, total + duration)
+
+  def Stats(self):
+    """Returns the number of renders and the average render time in
+    milliseconds per template, slowest first."""
+    with self._lock:
+      stats = [{'template': template,
+                'renders': count,
+                'average': round(total / count * 1000, 3)}
+               for template, (count, total) in self.timings.items()]
+    return sorted(stats, key=lambda stat: stat['average'], reverse=True)
+
+
+class RequestParser:
+  """The template parser of a single request.
+
+  Tags registered here, like the logged in user and their xsrf token, are
+  passed to the shared parser as replacements of each Parse call, so they do
+  not leak into other requests, also not those handled at the same time by
+  other threads. Everything else is looked up on the shared parser.
+  """
+
+  def __init__(self, parser):
+    self.shared = parser
+    self.tags = {}
+
+  def RegisterTag(self, tag, value):
+    """Registers a tag for the pages of this request only."""
+    self.tags[tag] = value
+
+  def Parse(self, template, **replacements):
+    """Renders the template with the tags of this request, which the given
+    replacements override."""
+    return self.shared.Parse(template, **dict(self.tags, **replacements))
+
+  def __getattr__(self, name):
+    return getattr(self.shared, name)
@@ -1,2 +1,4 @@
-#/bin/bash
-gunicorn3 'base:main()' --workers=1 -b :8001
+#!/bin/bash
+# Starts the warehouse under gunicorn with a worker per core, see
+# `python3 -m base.server --help` for the options.
+exec python3 -m base.server "$@"
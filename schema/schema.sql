@@ -32,6 +32,7 @@ CREATE TABLE `product` (
   `assemblycosts` decimal(5,3) NOT NULL DEFAULT '0.000',
   `vat` decimal(4,2) NOT NULL DEFAULT '0.00',
   `sku` varchar(45) DEFAULT NULL,
+  `barcode` varchar(20) DEFAULT NULL,
   `dateCreated` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
   `dateDeleted` datetime NOT NULL DEFAULT '1000-01-01 00:00:00',
   PRIMARY KEY (`ID`),
@@ -39,10 +40,27 @@ CREATE TABLE `product` (
   UNIQUE KEY `gs1_UNIQUE` (`gs1`,`dateDeleted`),
   UNIQUE KEY `sku_UNIQUE` (`supplier`,`sku`,`dateDeleted`),
   KEY `supplier` (`supplier`),
+  KEY `ean` (`ean`),
+  KEY `barcode` (`barcode`),
   CONSTRAINT `supplier` FOREIGN KEY (`supplier`) REFERENCES `supplier` (`ID`) ON UPDATE CASCADE
 ) ENGINE=InnoDB AUTO_INCREMENT=1 DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `productcost`
+--
+
+DROP TABLE IF EXISTS `productcost`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `productcost` (
+  `product` mediumint(8) unsigned NOT NULL,
+  `material` decimal(12,3) NOT NULL,
+  `assembly` decimal(12,3) NOT NULL,
+  PRIMARY KEY (`product`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `productpart`
 --
@@ -64,6 +82,35 @@ CREATE TABLE `productpart` (
 ) ENGINE=InnoDB AUTO_INCREMENT=1 DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `productsearch`
+--
+
+DROP TABLE IF EXISTS `productsearch`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `productsearch` (
+  `word` varchar(64) NOT NULL,
+  `product` mediumint(8) unsigned NOT NULL,
+  PRIMARY KEY (`word`,`product`),
+  KEY `product` (`product`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `productversion`
+--
+
+DROP TABLE IF EXISTS `productversion`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `productversion` (
+  `product` mediumint(8) unsigned NOT NULL,
+  `version` int(10) unsigned NOT NULL DEFAULT '0',
+  PRIMARY KEY (`product`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `stock`
 --
@@ -78,10 +125,25 @@ CREATE TABLE `stock` (
   `reference` varchar(45) DEFAULT NULL,
   `lot` varchar(45) DEFAULT NULL,
   `dateCreated` datetime DEFAULT CURRENT_TIMESTAMP,
-  PRIMARY KEY (`ID`)
+  PRIMARY KEY (`ID`),
+  KEY `product` (`product`,`dateCreated`)
 ) ENGINE=InnoDB AUTO_INCREMENT=1 DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `stockbalance`
+--
+
+DROP TABLE IF EXISTS `stockbalance`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `stockbalance` (
+  `product` mediumint(8) unsigned NOT NULL,
+  `amount` int(11) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`product`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `supplier`
 --
@@ -103,6 +165,20 @@ CREATE TABLE `supplier` (
 ) ENGINE=InnoDB AUTO_INCREMENT=1 DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `tableversion`
+--
+
+DROP TABLE IF EXISTS `tableversion`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `tableversion` (
+  `tablename` varchar(64) NOT NULL,
+  `version` int(10) unsigned NOT NULL DEFAULT '0',
+  PRIMARY KEY (`tablename`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `user`
 --
@@ -0,0 +1,11 @@
+-- Adds the materialized stock balance per product, and indexes the stock
+-- ledger on product.
+-- After applying, populate the balances with: warehouse stock --rebuild
+
+ALTER TABLE `stock` ADD KEY `product` (`product`,`dateCreated`);
+
+CREATE TABLE IF NOT EXISTS `stockbalance` (
+  `product` mediumint(8) unsigned NOT NULL,
+  `amount` int(11) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`product`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
@@ -0,0 +1,8 @@
+-- Adds the write version per table, used by the application caches to notice
+-- changes made by other processes.
+
+CREATE TABLE IF NOT EXISTS `tableversion` (
+  `tablename` varchar(64) NOT NULL,
+  `version` int(10) unsigned NOT NULL DEFAULT '0',
+  PRIMARY KEY (`tablename`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
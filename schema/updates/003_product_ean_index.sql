@@ -0,0 +1,3 @@
+-- Indexes the product ean, used to page through the EAN list.
+
+ALTER TABLE `product` ADD KEY `ean` (`ean`);
@@ -0,0 +1,9 @@
+-- Adds the word index used by the product search. Fill it for existing
+-- products afterwards with `warehouse search --rebuild`.
+
+CREATE TABLE IF NOT EXISTS `productsearch` (
+  `word` varchar(64) NOT NULL,
+  `product` mediumint(8) unsigned NOT NULL,
+  PRIMARY KEY (`word`,`product`),
+  KEY `product` (`product`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
@@ -0,0 +1,16 @@
+-- Stores the barcode of each product, its own ean or the gscode of its
+-- supplier followed by its gs1 code, and indexes it for the EAN search.
+
+ALTER TABLE `product`
+  ADD COLUMN `barcode` varchar(20) DEFAULT NULL AFTER `sku`,
+  ADD KEY `barcode` (`barcode`);
+
+UPDATE `product`
+  LEFT JOIN `supplier` ON `supplier`.`ID` = `product`.`supplier`
+  SET `product`.`barcode` = IF(
+    `product`.`ean` IS NOT NULL AND `product`.`ean` != "",
+    `product`.`ean`,
+    IF(`product`.`gs1` AND `supplier`.`gscode` REGEXP "^[0-9]+$",
+       CONCAT(CAST(`supplier`.`gscode` AS UNSIGNED),
+              LPAD(`product`.`gs1`, GREATEST(3, LENGTH(`product`.`gs1`)), "0")),
+       NULL));
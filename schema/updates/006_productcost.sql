@@ -0,0 +1,9 @@
+-- Stores the cost of products rolled up over their bill of materials. Rows
+-- are computed when they are first needed, so the table starts out empty.
+
+CREATE TABLE IF NOT EXISTS `productcost` (
+  `product` mediumint(8) unsigned NOT NULL,
+  `material` decimal(12,3) NOT NULL,
+  `assembly` decimal(12,3) NOT NULL,
+  PRIMARY KEY (`product`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
@@ -0,0 +1,9 @@
+-- Adds a version per product, bumped by every change to the product, its parts
+-- or their stock, and used as the ETag of product responses. Products without
+-- a row are at version 0.
+
+CREATE TABLE IF NOT EXISTS `productversion` (
+  `product` mediumint(8) unsigned NOT NULL,
+  `version` int(10) unsigned NOT NULL DEFAULT '0',
+  PRIMARY KEY (`product`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
@@ -41,7 +41,14 @@ setup(
     author_email='jan@underdark.nl',
     url='https://github.com/underdark.nl/warehouse',
     keywords='hwarehouseing software based on uWeb3',
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests', 'tests.*']),
     include_package_data=True,
     zip_safe=False,
-    install_requires=REQUIREMENTS)
+    install_requires=REQUIREMENTS,
+    extras_require={'production': ['gunicorn']},
+    entry_points={
+        'console_scripts': [
+            'warehouse = base.cli:main',
+            'warehouse-server = base.server:main',
+        ],
+    })
@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+"""Scratch database for the tests of the uWeb3 warehouse inventory software
+
+Tests that need MySQL run against the database named in the [mysql] section
+of the config file given by the WAREHOUSE_TEST_CONFIG environment variable.
+All tables in that database are dropped and recreated from schema/schema.sql,
+so never point it at a database holding real data. The tests are skipped when
+the variable is not set, or uweb3 is not installed.
+"""
+
+# standard modules
+import configparser
+import os
+import unittest
+
+SCHEMA = os.path.join(os.path.dirname(__file__), os.pardir, 'schema', 'schema.sql')
+
+
+def Options(section='mysql'):
+  """Returns the given section of the test config, or skips the test."""
+  configfile = os.environ.get('WAREHOUSE_TEST_CONFIG')
+  if not configfile:
+    raise unittest.SkipTest('WAREHOUSE_TEST_CONFIG names no scratch database')
+  try:
+    import uweb3 # pylint: disable=import-outside-toplevel,unused-import
+  except ImportError:
+    raise unittest.SkipTest('uweb3 is not installed')
+  config = configparser.ConfigParser()
+  config.read(configfile)
+  if section not in config:
+    raise unittest.SkipTest('%s has no [%s] section' % (configfile, section))
+  return dict(config[section])
+
+
+def Connect(options):
+  """Returns a new connection to the scratch database."""
+  from base import pool # pylint: disable=import-outside-toplevel
+  return pool.Connect(options)
+
+
+def LoadSchema(connection):
+  """Drops and recreates all tables of the scratch database."""
+  with open(SCHEMA, encoding='utf-8') as schema:
+    statements = schema.read().split(';\n')
+  with connection as cursor:
+    for statement in statements:
+      statement = '\n'.join(line for line in statement.splitlines()
+                            if not line.startswith('--')).strip()
+      if statement:
+        cursor.Execute(statement)
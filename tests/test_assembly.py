@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+"""Tests assembling products from the same parts at the same time"""
+
+# standard modules
+import threading
+import unittest
+
+# project modules
+from . import database
+
+
+class ConcurrentAssemblyTest(unittest.TestCase):
+  """Assembles a product from several connections against limited parts."""
+  PARTSTOCK = 10
+  PARTSPERASSEMBLY = 2
+  THREADS = 4
+  ATTEMPTS = 5
+
+  def setUp(self):
+    self.options = database.Options()
+    from base import model # pylint: disable=import-outside-toplevel
+    self.model = model
+    self.connection = database.Connect(self.options)
+    database.LoadSchema(self.connection)
+    supplier = model.Supplier.Create(self.connection, {'name': 'supplier'})
+    self.part = model.Product.Create(self.connection, {
+        'name': 'part', 'supplier': supplier.key})
+    self.assembly = model.Product.Create(self.connection, {
+        'name': 'assembly', 'supplier': supplier.key})
+    model.Productpart.Create(self.connection, {
+        'product': self.assembly.key,
+        'part': self.part.key,
+        'amount': self.PARTSPERASSEMBLY})
+    model.Stock.Create(self.connection, {
+        'product': self.part.key, 'amount': self.PARTSTOCK})
+
+  def testNoOversell(self):
+    """Concurrent assemblies never use more parts than there are in stock"""
+    start = threading.Barrier(self.THREADS)
+    assembled = []
+    errors = []
+
+    def Assemble():
+      product = self.model.Product.FromPrimary(database.Connect(self.options),
+                                               self.assembly.key)
+      start.wait()
+      for _attempt in range(self.ATTEMPTS):
+        try:
+          product.Assemble(1)
+          assembled.append(1)
+        except self.model.AssemblyError:
+          pass
+        except Exception as error: # pylint: disable=broad-except
+          errors.append(error)
+
+    threads = [threading.Thread(target=Assemble) for _thread in range(self.THREADS)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(errors, [])
+    self.assertLessEqual(len(assembled) * self.PARTSPERASSEMBLY, self.PARTSTOCK)
+    self.assertEqual(len(assembled), self.PARTSTOCK // self.PARTSPERASSEMBLY)
+    balances = self.model.Stockbalance.ForProducts(
+        self.connection, (self.part.key, self.assembly.key))
+    self.assertEqual(balances[self.part.key],
+                     self.PARTSTOCK - len(assembled) * self.PARTSPERASSEMBLY)
+    self.assertEqual(balances[self.assembly.key], len(assembled))
+    self.assertEqual(self.model.Stockbalance.Reconcile(self.connection), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+"""Tests the database connection pool against SQLite stand-in connections"""
+
+# standard modules
+import sqlite3
+import threading
+import time
+import unittest
+
+try:
+  from base import pool
+except ImportError:
+  raise unittest.SkipTest('uweb3 is not installed')
+
+
+class Cursor:
+  """The part of the sqltalk cursor the pool uses."""
+
+  def __init__(self, connection):
+    self.connection = connection
+
+  def Execute(self, query):
+    return self.connection.execute(query).fetchall()
+
+
+class Connection:
+  """A SQLite connection with the transaction interface of sqltalk."""
+
+  def __init__(self):
+    self.sqlite = sqlite3.connect(':memory:', check_same_thread=False)
+    self.broken = False
+    self.rollbacks = 0
+
+  def __enter__(self):
+    if self.broken:
+      raise sqlite3.OperationalError('connection lost')
+    return Cursor(self.sqlite)
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.sqlite.commit()
+    else:
+      self.sqlite.rollback()
+
+  def rollback(self):
+    if self.broken:
+      raise sqlite3.OperationalError('connection lost')
+    self.rollbacks += 1
+    self.sqlite.rollback()
+
+  def close(self):
+    self.sqlite.close()
+
+
+class ConnectionPoolTest(unittest.TestCase):
+  """Sizing, timeouts, reconnects and statistics of the pool."""
+
+  def Pool(self, **kwargs):
+    self.connections = []
+    def Factory():
+      connection = Connection()
+      self.connections.append(connection)
+      return connection
+    return pool.ConnectionPool(Factory, **kwargs)
+
+  def testMinimumSize(self):
+    """The pool opens minsize connections up front"""
+    connections = self.Pool(minsize=3, maxsize=5)
+    self.assertEqual(len(self.connections), 3)
+    stats = connections.Stats()
+    self.assertEqual((stats['size'], stats['idle'], stats['inuse']), (3, 3, 0))
+
+  def testMaximumSize(self):
+    """The pool grows on demand up to maxsize, and reuses returned ones"""
+    connections = self.Pool(minsize=0, maxsize=2, timeout=0.1)
+    first = connections.Get()
+    second = connections.Get()
+    self.assertIsNot(first, second)
+    self.assertEqual(connections.Stats()['inuse'], 2)
+    connections.Put(first)
+    self.assertIs(connections.Get(), first)
+    self.assertEqual(len(self.connections), 2)
+
+  def testCheckoutTimeout(self):
+    """A checkout waits at most the timeout for a connection"""
+    connections = self.Pool(minsize=1, maxsize=1, timeout=0.05)
+    connections.Get()
+    start = time.monotonic()
+    with self.assertRaises(pool.PoolExhaustedError):
+      connections.Get()
+    self.assertGreaterEqual(time.monotonic() - start, 0.05)
+    stats = connections.Stats()
+    self.assertEqual((stats['waits'], stats['timeouts']), (1, 1))
+
+  def testWaitForReturn(self):
+    """A waiting checkout gets the connection another thread returns"""
+    connections = self.Pool(minsize=1, maxsize=1, timeout=5)
+    connection = connections.Get()
+    timer = threading.Timer(0.05, connections.Put, (connection,))
+    timer.start()
+    self.assertIs(connections.Get(), connection)
+    timer.join()
+    stats = connections.Stats()
+    self.assertEqual(stats['waits'], 1)
+    self.assertGreater(stats['maxwaittime'], 0)
+
+  def testReconnectAfterFailedPing(self):
+    """An idle connection that fails its check is replaced"""
+    connections = self.Pool(minsize=1, maxsize=1)
+    connections.CHECKINTERVAL = 0
+    self.connections[0].broken = True
+    connection = connections.Get()
+    self.assertIs(connection, self.connections[1])
+    self.assertEqual(connections.Stats()['reconnects'], 1)
+    self.assertEqual(connections.Stats()['size'], 1)
+
+  def testRollbackOnReturn(self):
+    """Returned connections have their open transaction rolled back"""
+    connections = self.Pool(minsize=1, maxsize=1)
+    connection = connections.Get()
+    connection.sqlite.execute('CREATE TABLE stock (amount INTEGER)')
+    connection.sqlite.commit()
+    connection.sqlite.execute('INSERT INTO stock VALUES (1)')
+    connections.Put(connection)
+    self.assertEqual(connection.rollbacks, 1)
+    with connections.Get() as cursor:
+      self.assertEqual(cursor.Execute('SELECT COUNT(*) FROM stock'), [(0,)])
+
+  def testDiscardBroken(self):
+    """Connections that cannot roll back, or are discarded, are closed"""
+    connections = self.Pool(minsize=0, maxsize=2)
+    connection = connections.Get()
+    connection.broken = True
+    connections.Put(connection)
+    connections.Put(connections.Get(), discard=True)
+    stats = connections.Stats()
+    self.assertEqual((stats['discarded'], stats['size'], stats['idle']), (2, 0, 0))
+
+  def testConnectionContext(self):
+    """The with block returns the connection, also when it raises"""
+    connections = self.Pool(minsize=1, maxsize=1)
+    with self.assertRaises(ValueError):
+      with connections.Connection():
+        raise ValueError
+    with connections.Connection() as connection:
+      self.assertIs(connection, self.connections[0])
+    stats = connections.Stats()
+    self.assertEqual((stats['checkouts'], stats['idle'], stats['created']), (2, 1, 1))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+"""Tests which requests read from the read replica"""
+
+# standard modules
+import time
+import unittest
+
+try:
+  from base import pages
+  from base import pool
+except ImportError:
+  raise unittest.SkipTest('uweb3 is not installed')
+
+
+class Connection:
+  """Stands in for a database connection from the pool of a config section."""
+
+  def __init__(self, source):
+    self.source = source
+
+  def rollback(self):
+    pass
+
+
+class Request:
+  """The part of the uWeb3 request the connection routing uses."""
+
+  def __init__(self, method):
+    self.method = method
+    self.env = {}
+
+
+class Page(pages.PageMaker):
+  """A PageMaker without a running application around it."""
+  options = {'mysql': {}, pages.REPLICASECTION: {}}
+  cookies = None
+  req = None
+
+  def __init__(self, method='GET', cookies=None):
+    # pylint: disable=super-init-not-called
+    self.req = Request(method)
+    self.cookies = cookies or {}
+
+  @pages.readonly
+  def Read(self):
+    return self.connection
+
+  def Write(self):
+    return self.connection
+
+
+class ReplicaRoutingTest(unittest.TestCase):
+  """Readonly GET requests use the replica, everything else the primary."""
+
+  def setUp(self):
+    self.pools = pages.PageMaker.POOLS
+    pages.PageMaker.POOLS = {
+        section: pool.ConnectionPool(lambda section=section: Connection(section),
+                                     minsize=0, name=section)
+        for section in Page.options}
+
+  def tearDown(self):
+    pages.PageMaker.POOLS = self.pools
+
+  def Source(self, page, handler):
+    try:
+      return handler().source
+    finally:
+      pages.PageMaker.ReleaseConnection(page.req.env)
+
+  def testReadonlyGet(self):
+    """A GET to a readonly handler reads from the replica"""
+    page = Page('GET')
+    self.assertEqual(self.Source(page, page.Read), pages.REPLICASECTION)
+
+  def testReadonlyPost(self):
+    """A POST to a readonly handler uses the primary"""
+    page = Page('POST')
+    self.assertEqual(self.Source(page, page.Read), 'mysql')
+
+  def testOtherHandlers(self):
+    """Handlers that are not readonly use the primary, also for GET"""
+    page = Page('GET')
+    self.assertEqual(self.Source(page, page.Write), 'mysql')
+
+  def testStickyCookie(self):
+    """A client that changed something recently reads from the primary"""
+    page = Page('GET', {pages.STICKYCOOKIE: str(int(time.time()) + 10)})
+    self.assertEqual(self.Source(page, page.Read), 'mysql')
+    page = Page('GET', {pages.STICKYCOOKIE: str(int(time.time()) - 10)})
+    self.assertEqual(self.Source(page, page.Read), pages.REPLICASECTION)
+
+  def testWithoutReplica(self):
+    """Without a replica configured, every request uses the primary"""
+    page = Page('GET')
+    page.options = {'mysql': {}}
+    self.assertEqual(self.Source(page, page.Read), 'mysql')
+
+  def testPrimaryForWrites(self):
+    """Writes from a readonly handler go to the primary"""
+    page = Page('GET')
+    page.Read()
+    self.assertEqual(page.primary.source, 'mysql')
+    self.assertEqual(set(page.req.env[pages.CONNECTIONKEY]),
+                     {'mysql', pages.REPLICASECTION})
+    pages.PageMaker.ReleaseConnection(page.req.env)
+    self.assertEqual(pages.PageMaker.POOLS['mysql'].Stats()['idle'], 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
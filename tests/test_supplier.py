@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+"""Tests saving suppliers, and the barcodes derived from their gscode"""
+
+# standard modules
+import unittest
+
+# project modules
+from . import database
+
+try:
+  from base import model
+except ImportError:
+  raise unittest.SkipTest('uweb3 is not installed')
+
+
+class Cursor:
+  """Records the queries of a save, and answers the stored gscode."""
+
+  def __init__(self, gscode):
+    self.gscode = gscode
+    self.executed = []
+
+  def Select(self, table, fields=None, conditions=None, **kwargs):
+    return [{'gscode': self.gscode}]
+
+  def Execute(self, query):
+    self.executed.append(query)
+    return []
+
+
+class SupplierSaveHooksTest(unittest.TestCase):
+  """The save hooks of a supplier, without a database."""
+
+  def Save(self, supplier, storedgscode):
+    cursor = Cursor(storedgscode)
+    supplier._PreSave(cursor)
+    supplier._PostSave(cursor)
+    return [query for query in cursor.executed
+            if query.lstrip().startswith('UPDATE')]
+
+  def testSanitized(self):
+    """Saving cleans up the name and cuts off the gscode"""
+    supplier = model.Supplier(None, {'ID': 1, 'name': 'a supplier',
+                                     'gscode': '12345678901234'})
+    self.Save(supplier, '12345678901234')
+    self.assertEqual(supplier['name'], 'a_supplier')
+    self.assertEqual(supplier['gscode'], '1234567890')
+
+  def testUnchangedGscode(self):
+    """Saving other fields leaves the product barcodes alone"""
+    supplier = model.Supplier(None, {'ID': 1, 'name': 'supplier',
+                                     'gscode': '8712345'})
+    self.assertEqual(self.Save(supplier, 8712345), [])
+    supplier['gscode'] = None
+    self.assertEqual(self.Save(supplier, None), [])
+
+  def testChangedGscode(self):
+    """A new gscode rewrites the barcodes of the supplier's products"""
+    supplier = model.Supplier(None, {'ID': 1, 'name': 'supplier',
+                                     'gscode': '8712345'})
+    self.assertEqual(len(self.Save(supplier, '8700000')), 1)
+
+
+class SupplierSaveTest(unittest.TestCase):
+  """Saves a supplier in the scratch database."""
+
+  def setUp(self):
+    self.connection = database.Connect(database.Options())
+    database.LoadSchema(self.connection)
+    self.supplier = model.Supplier.Create(self.connection, {
+        'name': 'supplier', 'gscode': '8712345'})
+    self.product = model.Product.Create(self.connection, {
+        'name': 'product', 'gs1': 1, 'supplier': self.supplier.key})
+
+  def Barcode(self):
+    return model.Product.FromPrimary(self.connection, self.product.key)['barcode']
+
+  def testSave(self):
+    """Saving a supplier updates barcodes only when its gscode changed"""
+    barcode = self.Barcode()
+    self.supplier['website'] = 'https://example.com'
+    self.supplier.Save()
+    self.assertEqual(self.Barcode(), barcode)
+    self.supplier['gscode'] = '8799999'
+    self.supplier.Save()
+    self.assertTrue(str(self.Barcode()).startswith('8799999'))
+    self.assertEqual(model.Supplier.FromPrimary(
+        self.connection, self.supplier.key)['gscode'], '8799999')
+
+
+if __name__ == '__main__':
+  unittest.main()